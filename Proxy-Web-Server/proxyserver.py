@@ -1,14 +1,817 @@
 from socket import *
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from threading import BoundedSemaphore, Condition, Lock
+import argparse
+import hashlib
+import json
+import mmap
 import os
+import tempfile
+import time
 
 server_port = 8080
-max_backlog_connections = 1
+max_backlog_connections = 128
+max_workers = 32  # client connections handled at the same time
+max_per_origin = 4  # upstream fetches to one origin at the same time
+origin_wait_timeout = 10  # seconds a request waits for a free slot to its origin
+upstream_timeout = 10  # seconds an origin may stay silent before the fetch is given up
+client_timeout = 10  # seconds a client may stay silent, or stall a send, before it is dropped
+follow_timeout = origin_wait_timeout + upstream_timeout  # seconds a coalesced request waits for the download to move
+max_idle_per_host = 4  # idle keep-alive connections kept open to one origin
+upstream_idle_timeout = 30  # seconds an idle upstream connection is kept for reuse
+upstream_buffer_size = 65536  # receive buffer of each upstream connection, also the largest response head
+dns_ttl = 300  # seconds addresses are cached for, the system resolver does not report TTLs
+dns_negative_ttl = 30  # seconds a failed lookup is cached for
+dns_stale_grace = 60  # seconds past its TTL an entry is still used while it is refreshed in the background
+dns_timeout = 10  # seconds a request waits for a lookup
+dns_workers = 4  # lookups running at the same time
+dns_max_entries = 10000
 cache_dir = 'cache'
+cache_index_name = 'index.jsonl'  # journal of the cache's metadata, inside cache_dir
+cache_journal_slack = 1000  # stale journal records tolerated before it is compacted
+mmap_max_size = 64 * 1024  # cache hits this size or smaller are served from memory maps, larger ones with sendfile
+mmap_max_bytes = 16 * 1024 * 1024  # total size of the memory maps of recently hit small responses
+cache_max_bytes = 256 * 1024 * 1024  # disk budget of the cache, least recently used responses go first
+max_object_size = 32 * 1024 * 1024  # larger responses are relayed but not cached
+heuristic_max_lifetime = 86400  # cap in seconds on freshness guessed from Last-Modified
+cacheable_statuses = {200, 203, 300, 301, 308, 410}  # cacheable unless the origin says otherwise
 # create cache directory if it doesn't exist
 if not os.path.exists(cache_dir):
     os.makedirs(cache_dir)
 
 
+class OriginLimiter:
+    '''
+    Caps the upstream fetches running against each origin host,
+    so one slow origin cannot take up every worker.
+    '''
+
+    def __init__(self, per_origin):
+        self.per_origin = per_origin
+        self.active = {}  # host : fetches in progress, only hosts with some
+        self.cond = Condition()
+
+    def acquire(self, host, timeout=origin_wait_timeout):
+        # returns False if no slot to host came free within timeout
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.active.get(host, 0) < self.per_origin, timeout):
+                return False
+            self.active[host] = self.active.get(host, 0) + 1
+            return True
+
+    def release(self, host):
+        with self.cond:
+            self.active[host] -= 1
+            if not self.active[host]:
+                del self.active[host]
+            self.cond.notify_all()
+
+
+origin_limiter = OriginLimiter(max_per_origin)
+
+
+class UpstreamPool:
+    '''
+    Idle persistent HTTP/1.1 connections to origin servers, kept per host so repeated
+    fetches skip the TCP handshake. Connections idle for idle_timeout are closed
+    instead of reused, and at most max_idle are kept per host.
+    '''
+
+    def __init__(self, max_idle=max_idle_per_host, idle_timeout=upstream_idle_timeout):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # host : deque of (UpstreamConnection, time it went idle), oldest first
+        self.lock = Lock()
+        self.connects = 0
+        self.reuses = 0
+
+    def get(self, host):
+        '''
+        Returns (connection, reused): the most recently used live idle UpstreamConnection
+        to host, or a new one.
+        '''
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self.lock:
+            conns = self.idle.get(host)
+            while conns and now - conns[0][1] >= self.idle_timeout:
+                stale.append(conns.popleft()[0])
+            while conns and conn is None:
+                conn, _ = conns.pop()
+                if not is_alive(conn.sock):
+                    stale.append(conn)
+                    conn = None
+            if not conns:
+                self.idle.pop(host, None)
+            if conn is not None:
+                self.reuses += 1
+            else:
+                self.connects += 1
+
+        for old in stale:
+            old.close()
+        if conn is not None:
+            return conn, True
+
+        return UpstreamConnection(connect(host)), False
+
+    def put(self, host, conn):
+        # keep a connection whose last response was fully read for the next fetch to host
+        with self.lock:
+            conns = self.idle.setdefault(host, deque())
+            if len(conns) < self.max_idle:
+                conns.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def stats(self):
+        with self.lock:
+            return {'connects': self.connects, 'reuses': self.reuses,
+                    'idle': sum(len(conns) for conns in self.idle.values())}
+
+
+upstream_pool = UpstreamPool()
+
+
+def system_resolver(host):
+    '''
+    Resolves host with getaddrinfo. Returns (addresses, ttl); getaddrinfo does not
+    report TTLs, so ttl is None and the DnsCache default applies.
+    '''
+    addresses = []
+    for _, _, _, _, sockaddr in getaddrinfo(host, 80, AF_UNSPEC, SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses, None
+
+
+class DnsCache:
+    '''
+    Origin addresses by host name, kept for their TTL, and failed lookups kept for
+    negative_ttl. Lookups run on a small executor, one at a time per host, and an
+    entry past its TTL is still answered for stale_grace while it is refreshed in the
+    background, so requests to a busy origin never wait on DNS.
+    resolver(host) returns (addresses, ttl or None) and raises gaierror for unknown
+    hosts; a stub can be passed in to run without a network, for example
+    DnsCache(lambda host: (['127.0.0.1'], 60)).
+    '''
+
+    def __init__(self, resolver=system_resolver, ttl=dns_ttl, negative_ttl=dns_negative_ttl,
+                 stale_grace=dns_stale_grace, workers=dns_workers):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_grace = stale_grace
+        self.entries = {}  # host : (addresses or the gaierror of a failed lookup, expiry time)
+        self.pending = {}  # host : Future of the lookup in progress
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = Lock()
+        self.stats_counts = {'hits': 0, 'negative_hits': 0, 'stale_hits': 0, 'lookups': 0}
+
+    def resolve(self, host, wait=dns_timeout):
+        # returns the addresses of host, raising gaierror if it does not resolve
+        now = time.monotonic()
+        with self.lock:
+            cached = self.entries.get(host)
+            if cached is not None:
+                result, expires_at = cached
+                if now < expires_at:
+                    self.stats_counts['negative_hits' if isinstance(result, Exception) else 'hits'] += 1
+                    return self.result(result)
+                if now < expires_at + self.stale_grace and not isinstance(result, Exception):
+                    self.stats_counts['stale_hits'] += 1
+                    self.lookup(host)
+                    return result
+            future = self.lookup(host)
+
+        try:
+            return self.result(future.result(wait))
+        except FutureTimeoutError:
+            raise timeout(f'DNS lookup of {host} timed out')
+
+    def result(self, result):
+        # a cached failure is raised as a new error, so tracebacks do not pile up on it
+        if isinstance(result, Exception):
+            raise gaierror(result.errno, result.strerror)
+        return result
+
+    def lookup(self, host):
+        # the lookup of host in progress, starting one if there is none; called with the lock held
+        future = self.pending.get(host)
+        if future is None:
+            future = self.pending[host] = self.executor.submit(self.run_lookup, host)
+            self.stats_counts['lookups'] += 1
+        return future
+
+    def run_lookup(self, host):
+        result, expires_at = None, None
+        try:
+            addresses, ttl = self.resolver(host)
+            if not addresses:
+                raise gaierror(EAI_NONAME, f'{host} has no addresses')
+            result, expires_at = addresses, time.monotonic() + (self.ttl if ttl is None else ttl)
+            print(f'DNS: {host} is {", ".join(addresses)}')
+        except Exception as e:
+            # any failure (a bad name, a broken resolver) is cached like a name that does not exist
+            if not isinstance(e, gaierror):
+                e = gaierror(EAI_FAIL, f'{type(e).__name__}: {e}')
+            result, expires_at = e, time.monotonic() + self.negative_ttl
+            print(f'DNS: {host} did not resolve: {e}')
+        finally:
+            with self.lock:
+                if result is not None:
+                    if host not in self.entries and len(self.entries) >= dns_max_entries:
+                        self.prune()
+                    self.entries[host] = (result, expires_at)
+                del self.pending[host]
+        return result
+
+    def prune(self):
+        # make room by dropping expired entries, or else the oldest; called with the lock held
+        now = time.monotonic()
+        for host, (_, expires_at) in list(self.entries.items()):
+            if now >= expires_at + self.stale_grace:
+                del self.entries[host]
+        while len(self.entries) >= dns_max_entries:
+            del self.entries[next(iter(self.entries))]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.stats_counts, hosts=len(self.entries))
+
+
+dns_cache = DnsCache()
+
+
+def connect(host):
+    # connects to port 80 of host, trying each of its addresses in turn
+    last_error = None
+    for address in dns_cache.resolve(host):
+        sock = socket(AF_INET6 if ':' in address else AF_INET, SOCK_STREAM)
+        sock.settimeout(upstream_timeout)
+        try:
+            sock.connect((address, 80))
+            return sock
+        except error as e:
+            sock.close()
+            last_error = e
+    raise last_error
+
+
+class CacheEntry:
+    __slots__ = ('key', 'size', 'stored_at', 'lifetime', 'etag', 'last_modified', 'last_access')
+
+    def __init__(self, key, size, stored_at, lifetime, etag=None, last_modified=None, last_access=None):
+        self.key = key
+        self.size = size
+        self.stored_at = stored_at
+        self.lifetime = lifetime
+        self.etag = etag
+        self.last_modified = last_modified
+        self.last_access = last_access or stored_at
+
+    def is_fresh(self, now):
+        return now - self.stored_at < self.lifetime
+
+    def has_validators(self):
+        return self.etag is not None or self.last_modified is not None
+
+    def to_record(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ProxyCache:
+    '''
+    On-disk cache of complete responses, bounded by max_bytes.
+    Entries are served while fresh (Cache-Control, Expires or a Last-Modified heuristic)
+    and revalidated with the origin once stale.
+
+    Each response is stored under the SHA-1 of its URL, sharded two levels deep
+    (ab/cd/abcd...), so no directory grows large and URLs of any length fit.
+    The metadata of every entry lives in memory, in least recently used order, so a
+    lookup never touches the filesystem. Changes are appended to an index journal
+    that is replayed at startup and compacted once it is mostly stale records.
+    Recently hit small responses stay memory mapped, so hot hits skip opening the file.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key : CacheEntry, least recently used first
+        self.size = 0
+        self.lock = Lock()
+        self.index_path = os.path.join(directory, cache_index_name)
+        self.journal = None
+        self.journal_records = 0
+        self.maps = OrderedDict()  # key : (CacheEntry, mmap), least recently used first
+        self.mapped_bytes = 0
+        self.stats_counts = {'hits': 0, 'misses': 0, 'stale': 0, 'revalidated': 0,
+                             'bypassed': 0, 'stored': 0, 'not_stored': 0, 'evicted': 0}
+        self.load()
+
+    def path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def load(self):
+        # replay the index journal, then start a compacted one
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name != cache_index_name and os.path.isfile(path):
+                # a transfer cut short by a crash, or a file from an older cache layout
+                print(f'CACHE: DISCARDED {name}')
+                remove_file(path)
+
+        entries = {}
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        if record.get('deleted'):
+                            entries.pop(record['key'], None)
+                        else:
+                            entries[record['key']] = CacheEntry(**record)
+                    except (ValueError, TypeError, KeyError):
+                        continue  # torn last record of a crash
+        except FileNotFoundError:
+            pass
+
+        for entry in sorted(entries.values(), key=lambda entry: entry.last_access):
+            self.entries[entry.key] = entry
+            self.size += entry.size
+        print(f'CACHE: LOADED {len(self.entries)} responses, {self.size} bytes')
+        with self.lock:
+            self.compact()
+        self.evict()
+
+    def mapped(self, entry):
+        '''
+        Returns a memoryview of a small cached response, mapping it on its first hit,
+        or None if it is too large to keep mapped.
+        '''
+        if entry.size > mmap_max_size:
+            return None
+        with self.lock:
+            mapped = self.maps.get(entry.key)
+            if mapped is not None and mapped[0] is entry:
+                self.maps.move_to_end(entry.key)
+                return memoryview(mapped[1])
+
+        with open(self.path(entry.key), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self.lock:
+            self.unmap(entry.key)
+            self.maps[entry.key] = (entry, mm)
+            self.mapped_bytes += len(mm)
+            while self.mapped_bytes > mmap_max_bytes:
+                self.unmap(next(iter(self.maps)))
+        return memoryview(mm)
+
+    def unmap(self, key):
+        # forget a map; called with the lock held. It is not closed, a hit may still be
+        # sending from it, and is unmapped once the last view of it is released
+        mapped = self.maps.pop(key, None)
+        if mapped is not None:
+            self.mapped_bytes -= len(mapped[1])
+
+    def compact(self):
+        # rewrite the journal as one record per entry, in LRU order; called with the lock held
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry.to_record()) + '\n')
+        os.replace(temp_path, self.index_path)
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.index_path, 'a', encoding='utf-8')
+        self.journal_records = len(self.entries)
+
+    def record(self, record):
+        # append a change to the journal; called with the lock held
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        self.journal_records += 1
+        if self.journal_records > 2 * len(self.entries) + cache_journal_slack:
+            self.compact()
+
+    def close(self):
+        # save the access order and close the journal
+        with self.lock:
+            self.compact()
+            self.journal.close()
+
+    def lookup(self, key, request_headers):
+        '''
+        Returns (entry, outcome): outcome is 'hit' for a fresh entry, 'stale' for an
+        entry to revalidate, 'miss' with no entry, or 'bypass' if the client asked
+        the cache to stay out of the way.
+        '''
+        request_cc = parse_cache_control(request_headers.get('cache-control', ''))
+        if 'no-store' in request_cc or 'authorization' in request_headers:
+            outcome, entry = 'bypass', None
+        else:
+            now = time.time()
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    entry.last_access = now
+
+            if entry is None:
+                outcome = 'miss'
+            elif ('no-cache' in request_cc or request_cc.get('max-age') == '0'
+                  or 'no-cache' in request_headers.get('pragma', '')):
+                outcome = 'stale'
+            elif entry.is_fresh(now):
+                outcome = 'hit'
+            else:
+                outcome = 'stale'
+
+        self.count({'hit': 'hits', 'miss': 'misses', 'stale': 'stale', 'bypass': 'bypassed'}[outcome])
+        print(f'CACHE: {outcome.upper()} {key}')
+        return entry, outcome
+
+    def open_writer(self, key, status, request_headers, headers):
+        '''
+        Returns a CacheWriter to stream a response into the cache while it is relayed,
+        or None (logging why, and dropping any older copy) if it must not be stored.
+        '''
+        try:
+            size = int(headers.get('content-length', 0))
+        except ValueError:
+            size = 0
+        reason = not_cacheable_reason(status, request_headers, headers, size)
+        if reason is None:
+            try:
+                return CacheWriter(self, key, headers)
+            except OSError as e:
+                reason = e.strerror
+
+        self.not_stored(key, reason)
+        self.remove(key)
+        return None
+
+    def not_stored(self, key, reason):
+        self.count('not_stored')
+        print(f'CACHE: NOT STORED {key}: {reason}')
+
+    def commit(self, key, temp_path, size, headers):
+        # move a completely written response into place, replacing any older copy
+        now = time.time()
+        entry = CacheEntry(key, size, now, freshness_lifetime(headers, now),
+                           headers.get('etag'), headers.get('last-modified'))
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except OSError as e:
+            remove_file(temp_path)
+            self.not_stored(key, e.strerror)
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+                self.unmap(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            self.stats_counts['stored'] += 1
+            self.record(entry.to_record())
+        print(f'CACHE: STORED {key} ({entry.size} bytes, fresh for {entry.lifetime:.0f}s)')
+        self.evict()
+
+    def revalidated(self, key, entry, headers):
+        # the origin answered 304: the stored response is fresh again
+        now = time.time()
+        with self.lock:
+            if has_freshness(headers):
+                entry.lifetime = freshness_lifetime(headers, now)
+            entry.stored_at = now
+            if self.entries.get(key) is entry:
+                self.record(entry.to_record())
+        self.count('revalidated')
+        print(f'CACHE: REVALIDATED {key} (fresh for {entry.lifetime:.0f}s)')
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+                self.unmap(key)
+                self.record({'key': key, 'deleted': True})
+        if entry is not None:
+            remove_file(self.path(key))
+
+    def evict(self):
+        # drop least recently used responses until back under budget
+        evicted = []
+        with self.lock:
+            while self.size > self.max_bytes:
+                key, entry = self.entries.popitem(last=False)
+                self.size -= entry.size
+                self.unmap(key)
+                self.stats_counts['evicted'] += 1
+                self.record({'key': key, 'deleted': True})
+                evicted.append(entry)
+        for entry in evicted:
+            remove_file(self.path(entry.key))
+            print(f'CACHE: EVICTED {entry.key} ({entry.size} bytes)')
+
+    def count(self, name):
+        with self.lock:
+            self.stats_counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.stats_counts, responses=len(self.entries), bytes=self.size)
+
+
+class CacheWriter:
+    '''
+    Streams one response into a temporary file in the cache directory as it is relayed.
+    commit() renames the file into place, so readers never see a partial response,
+    and a transfer that fails or grows too large leaves nothing behind.
+    '''
+
+    def __init__(self, cache, key, headers):
+        self.cache = cache
+        self.key = key
+        self.headers = headers
+        self.max_size = min(max_object_size, cache.max_bytes)
+        self.size = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, prefix='.', suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if self.file is None:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.abort(f'larger than {self.max_size} bytes')
+            return
+        try:
+            # flushed right away so requests following the download can read it
+            self.file.write(data)
+            self.file.flush()
+        except OSError as e:
+            self.abort(e.strerror)
+
+    def is_open(self):
+        return self.file is not None
+
+    def commit(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError as e:
+            self.abort(e.strerror)
+            return
+        self.file = None
+        self.cache.commit(self.key, self.temp_path, self.size, self.headers)
+
+    def abort(self, reason):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+        remove_file(self.temp_path)
+        self.cache.not_stored(self.key, reason)
+
+
+class Download:
+    '''
+    A response on its way from the origin into the cache. Other requests for the same
+    URL follow it, streaming from its temporary cache file as it grows, instead of
+    fetching the URL again.
+    '''
+
+    def __init__(self):
+        self.cond = Condition()
+        self.state = 'pending'  # then 'streaming', and finally 'done' or 'closed'
+        self.path = None  # temporary cache file, while streaming
+        self.size = 0  # bytes written to it so far
+
+    def streaming(self, path):
+        with self.cond:
+            self.state = 'streaming'
+            self.path = path
+            self.cond.notify_all()
+
+    def wrote(self, size):
+        with self.cond:
+            self.size = size
+            self.cond.notify_all()
+
+    def complete(self, writer):
+        # commit with the lock held, so a new follower finds either the temporary file or the entry
+        with self.cond:
+            writer.commit()
+            self.state = 'done'
+            self.cond.notify_all()
+
+    def close(self):
+        # the download ended without a complete shareable response
+        with self.cond:
+            if self.state != 'done':
+                self.state = 'closed'
+            self.cond.notify_all()
+
+
+class Downloads:
+    '''
+    Downloads in progress by cache key, so concurrent misses for one URL
+    turn into a single upstream fetch.
+    '''
+
+    def __init__(self):
+        self.downloads = {}  # key : Download
+        self.lock = Lock()
+
+    def join(self, key):
+        # returns (download, leader): the leader fetches, everyone else follows
+        with self.lock:
+            download = self.downloads.get(key)
+            if download is not None:
+                return download, False
+            download = self.downloads[key] = Download()
+            return download, True
+
+    def finish(self, key, download):
+        download.close()
+        with self.lock:
+            if self.downloads.get(key) is download:
+                del self.downloads[key]
+
+
+downloads = Downloads()
+
+
+def fits_writer(writer, response_head, headers):
+    # only a response known to fit in the cache is shared: if the writer gave up part way,
+    # followers that already sent a 200 head could only cut the response short
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return False
+    length = headers.get('content-length', '')
+    return length.isdigit() and len(response_head) + int(length) <= writer.max_size
+
+
+def follow(connection_socket, download):
+    '''
+    Streams a download in progress to the client. Returns False without sending anything
+    if it is not shared (not cacheable, revalidated, or failed before it started).
+    '''
+    with download.cond:
+        if not download.cond.wait_for(lambda: download.state != 'pending', follow_timeout):
+            return False  # the download never started, fetch alone
+        if download.state != 'streaming':
+            return False
+        try:
+            f = open(download.path, 'rb')
+        except OSError:
+            return False
+
+    with f:
+        sent = 0
+        while True:
+            with download.cond:
+                if not download.cond.wait_for(lambda: download.size > sent or download.state != 'streaming',
+                                              follow_timeout):
+                    return True  # the download stalled, the client sees the connection close
+                size, state = download.size, download.state
+            if size > sent:
+                sent += connection_socket.sendfile(f, sent, size - sent)
+            elif state != 'streaming':
+                # done, or closed part way and the client sees the connection close
+                return True
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def parse_cache_control(value):
+    # Cache-Control directives as lowercase name : argument ('' if none)
+    directives = {}
+    for item in value.split(','):
+        name, _, arg = item.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def has_freshness(headers):
+    cache_control = parse_cache_control(headers.get('cache-control', ''))
+    return 's-maxage' in cache_control or 'max-age' in cache_control or 'expires' in headers
+
+
+def freshness_lifetime(headers, now):
+    '''
+    Returns the seconds a response stays fresh after it was received: from s-maxage,
+    max-age or Expires, else 10% of its age since Last-Modified, less any Age.
+    '''
+    cache_control = parse_cache_control(headers.get('cache-control', ''))
+    date = parse_http_date(headers.get('date')) or now
+    if 'no-cache' in cache_control:
+        lifetime = 0
+    elif 's-maxage' in cache_control or 'max-age' in cache_control:
+        try:
+            lifetime = int(cache_control.get('s-maxage', cache_control.get('max-age')))
+        except ValueError:
+            lifetime = 0
+    elif 'expires' in headers:
+        # an invalid Expires means already expired
+        expires = parse_http_date(headers['expires'])
+        lifetime = expires - date if expires is not None else 0
+    elif 'last-modified' in headers:
+        last_modified = parse_http_date(headers['last-modified'])
+        lifetime = min((date - last_modified) / 10, heuristic_max_lifetime) if last_modified else 0
+    else:
+        lifetime = 0
+
+    try:
+        age = int(headers.get('age', 0))
+    except ValueError:
+        age = 0
+    return max(lifetime - age, 0)
+
+
+def not_cacheable_reason(status, request_headers, headers, size):
+    # returns why a response must not be stored, or None if it may be
+    cache_control = parse_cache_control(headers.get('cache-control', ''))
+    request_cc = parse_cache_control(request_headers.get('cache-control', ''))
+    if status in (206, 304) or (status not in cacheable_statuses and not has_freshness(headers)):
+        return f'status {status}'
+    if 'no-store' in cache_control or 'no-store' in request_cc:
+        return 'no-store'
+    if 'private' in cache_control:
+        return 'private'
+    if 'authorization' in request_headers and 'public' not in cache_control:
+        return 'authorized request'
+    # responses are keyed by URL alone, so one that varies on a request header the
+    # origin actually sees could be the wrong representation for the next client
+    vary = {name.strip().lower() for name in headers.get('vary', '').split(',') if name.strip()}
+    if vary - negotiation_headers:
+        return f'Vary: {headers["vary"]}'
+    if size > max_object_size:
+        return f'larger than {max_object_size} bytes'
+    if (freshness_lifetime(headers, time.time()) == 0
+            and 'etag' not in headers and 'last-modified' not in headers):
+        return 'never fresh and cannot be revalidated'
+    return None
+
+
+proxy_cache = None  # ProxyCache, created by main
+
+# request headers that are not forwarded to the origin
+hop_by_hop_headers = {'connection', 'proxy-connection', 'keep-alive'}
+conditional_headers = {'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since',
+                       'if-range', 'range'}
+# dropped so every response is fetched uncompressed, the one representation all clients accept
+negotiation_headers = {'accept-encoding'}
+
+
+def is_alive(sock):
+    # an idle connection the origin has closed reads as EOF (or has stray data) right away
+    sock.setblocking(False)
+    try:
+        sock.recv(1, MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except error:
+        return False
+    finally:
+        sock.settimeout(upstream_timeout)
+
+
 def parse_url(url):
     if url.startswith('/'):
         url = url[1:]
@@ -25,83 +828,412 @@ def parse_url(url):
     return host, path
 
 
-def main():
-    proxy_socket = socket(AF_INET, SOCK_STREAM)
-    proxy_socket.bind(('', server_port))
-    proxy_socket.listen(max_backlog_connections)
+def send_error(connection_socket, status_code, message):
+    response = f'HTTP/1.1 {status_code}\r\n'
 
-    print(f'Proxy server listening to port {server_port}')
+    # add headers
+    response += f'Content-Type: text/html\r\n'
+    response += f'Content-Length: {len(message)}\r\n'
+    response += '\r\n'
+    connection_socket.sendall(response.encode() + message.encode())
 
-    # main server loop
+
+class UpstreamConnection:
+    '''
+    A connection to an origin server and an incremental HTTP/1.1 response parser over it.
+    Data is received with recv_into into one preallocated buffer that lives as long as
+    the connection; buffer[start:end] holds the bytes received but not parsed or relayed
+    yet. Bodies are framed by Content-Length or chunked encoding, or by the origin
+    closing the connection when a response has neither.
+    '''
+
+    def __init__(self, sock, buffer_size=upstream_buffer_size):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def close(self):
+        self.sock.close()
+
+    def fill(self, eof_ok=False):
+        '''
+        Receives more data after the unparsed bytes, moving them to the front of the
+        buffer first if it is full. Returns False at EOF if eof_ok, else raises.
+        '''
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if self.start == 0:
+                raise ValueError('response line or head larger than the buffer')
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        count = self.sock.recv_into(self.view[self.end:])
+        if not count:
+            if eof_ok:
+                return False
+            raise ConnectionError('origin closed the connection mid-response')
+        self.end += count
+        return True
+
+    def find(self, separator, offset=0):
+        # position of separator in the unparsed bytes, at least offset in, receiving more until it shows up
+        while True:
+            pos = self.buffer.find(separator, self.start + offset, self.end)
+            if pos != -1:
+                return pos - self.start
+            offset = max(self.end - self.start - len(separator) + 1, 0)
+            self.fill()
+
+    def read_head(self):
+        '''
+        Reads the next response head.
+        Returns the raw head, the HTTP version, the status code and a dict of lowercase headers.
+        '''
+        length = self.find(b'\r\n\r\n') + 4
+        head = bytes(self.view[self.start:self.start + length])
+        self.start += length
+        return (head,) + parse_response_head(head)
+
+    def relay(self, count, send):
+        # relays the next count bytes, sending views of the buffer without copying them
+        while count > 0:
+            if self.start == self.end:
+                self.fill()
+            piece = min(count, self.end - self.start)
+            send(self.view[self.start:self.start + piece])
+            self.start += piece
+            count -= piece
+
+    def relay_chunked(self, send):
+        # relays a chunked body as is: every chunk, the last chunk and the trailers
+        while True:
+            line_end = self.find(b'\r\n')
+            size_line = bytes(self.view[self.start:self.start + line_end])
+            size = int(size_line.split(b';')[0], 16)
+            if size == 0:
+                break
+            self.relay(line_end + 2 + size + 2, send)
+
+        # the last chunk line ends the body if no trailer lines follow it
+        self.relay(self.find(b'\r\n\r\n', line_end) + 4, send)
+
+    def relay_body(self, version, status, headers, send):
+        '''
+        Relays the body of the response whose head was just read.
+        Returns True if the connection can be reused for another request.
+        '''
+        if 100 <= status < 200 or status in (204, 304):
+            pass  # never has a body
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.relay_chunked(send)
+        elif 'content-length' in headers:
+            self.relay(int(headers['content-length']), send)
+        else:
+            while self.start < self.end or self.fill(eof_ok=True):
+                send(self.view[self.start:self.end])
+                self.start = self.end
+            return False
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+        # anything past the body was not asked for, so the connection is out of step
+        return keep_alive and self.start == self.end
+
+
+def parse_response_head(head):
+    # split a response head into the HTTP version, status code and a dict of lowercase headers
+    lines = head.decode('iso-8859-1').split('\r\n')
+    version, status = lines[0].split(' ', 2)[:2]
+    return version, int(status), parse_headers(lines[1:])
+
+
+def parse_headers(lines):
+    headers = {}
+    for line in lines:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def client_head(head):
+    # the proxy closes the client connection after each response, so say so
+    lines = head.decode('iso-8859-1').split('\r\n')[:-2]
+    lines = [line for line in lines
+             if line.split(':', 1)[0].strip().lower() not in ('connection', 'keep-alive')]
+    return ('\r\n'.join(lines) + '\r\nConnection: close\r\n\r\n').encode('iso-8859-1')
+
+
+def send_cached(connection_socket, entry):
+    # small hot responses are sent from their memory map, others go from the page cache with sendfile
+    view = proxy_cache.mapped(entry)
+    if view is not None:
+        with view:
+            connection_socket.sendall(view)
+        return
+
+    with open(proxy_cache.path(entry.key), 'rb') as f:
+        connection_socket.sendfile(f)
+
+
+def fetch(connection_socket, host, request, key, request_headers, entry=None, download=None):
+    '''
+    Sends request to host over a pooled keep-alive connection, relays the response and
+    offers it to the cache. A cacheable response whose Content-Length fits in the
+    cache is shared with the requests following download as it arrives. A request
+    revalidating a stale entry that gets 304 is answered from the cache. A reused
+    connection the origin closed before answering is retried on a new one.
+    '''
     while True:
-        # wait for client connection
-        print('LISTENING: Waiting for a new connection...')
-        connection_socket, addr = proxy_socket.accept()
+        upstream, reused = upstream_pool.get(host)
+        print(f'BUSY: {"Reusing connection" if reused else "Connected"} to {host}')
+        try:
+            # send client request to the requested server
+            upstream.sock.sendall(request.encode())
+            head, version, status, headers = upstream.read_head()
+            break
+        except (error, ValueError) as e:
+            upstream.close()
+            if not reused or isinstance(e, ValueError):
+                raise
 
-        # get request
-        request = connection_socket.recv(1024).decode()
+    writer = None
+    started = False  # whether part of the response went out to the client
+    try:
+        if entry is not None and status == 304:
+            reusable = upstream.relay_body(version, status, headers, None)
+        else:
+            # stream the response to the client and into the cache at the same time
+            writer = proxy_cache.open_writer(key, status, request_headers, headers)
+            response_head = client_head(head)
+            if writer and download and fits_writer(writer, response_head, headers):
+                download.streaming(writer.temp_path)
+            elif download:
+                download.close()  # not shared, followers fetch for themselves right away
+                download = None
 
-        if request:
-            method, url, _ = request.split('\n')[0].split(' ')
-            if method != 'GET':  # only handle GET requests
-                connection_socket.close()
-                return
+            client_gone = False
 
-            # extract host and create file path for caching
-            host, path = parse_url(url)
-            file_path = os.path.join(cache_dir, host + url.replace('/', '_'))
-
-            new_request_line = f'GET {path} HTTP/1.1\r\n'
-            modified_request = new_request_line
-            request_lines = request.split('\n')
-            for i in range(1, len(request_lines)):
-                line = request_lines[i]
-                if line.lower().startswith('host:'):
-                    modified_request += f'Host: {host}\r\n'
-                else:
-                    modified_request += line + '\n'
-
-            # send cached data if it exists
-            if os.path.exists(file_path):
-                with open(file_path, 'rb') as f:
-                    cached_data = f.read()
-                    connection_socket.sendall(cached_data)
-            else:
+            def send(data):
+                # into the cache first, so followers do not wait on this request's client
+                nonlocal started, client_gone
+                if writer:
+                    writer.write(data)
+                if writer and download:
+                    if writer.is_open():
+                        download.wrote(writer.size)
+                    else:
+                        download.close()  # no longer cached, so followers get no more
+                caching = writer is not None and writer.is_open()
+                if client_gone:
+                    if not caching:
+                        raise ConnectionAbortedError('client went away and nothing is cached')
+                    return
+                started = True
                 try:
-                    # connect to the requested web server
-                    server_socket = socket(AF_INET, SOCK_STREAM)
-                    server_socket.connect((host, 80))
-                    print(f'BUSY: Connected to {host}')
-
-                    # send client request to the requested server
-                    server_socket.sendall(modified_request.encode())
-
-                    response = b''  # store response as binary
-                    while True:
-                        data = server_socket.recv(2048)
-                        if not data:
-                            break
-                        response += data
-                        connection_socket.sendall(data)
-
-                    # cache full response
-                    with open(file_path, 'wb') as f:
-                        f.write(response)
-
-                    server_socket.close()
+                    connection_socket.sendall(data)
                 except error:
-                    not_found_msg = ('<h1>404 Not Found</h1>'
-                                     '<p>Could not connect to the requested server.</p>')
-                    response = 'HTTP/1.1 404 Not Found\r\n'
+                    if not caching:
+                        raise
+                    # keep the download going for the cache and the requests following it
+                    client_gone = True
+                    print(f'CACHE: Client of {key} went away, still downloading')
+
+            send(response_head)
+            reusable = upstream.relay_body(version, status, headers, send)
+    except BaseException as e:
+        upstream.close()
+        if writer:
+            writer.abort('transfer failed')
+        if started and isinstance(e, error):
+            return  # too late for an error page, the client sees the connection close
+        raise
+
+    if reusable:
+        upstream_pool.put(host, upstream)
+    else:
+        upstream.close()
+
+    if entry is not None and status == 304:
+        proxy_cache.revalidated(key, entry, headers)
+        send_cached(connection_socket, entry)
+    elif writer and download:
+        download.complete(writer)
+    elif writer:
+        writer.commit()
+
+
+def lookup(connection_socket, key, request_headers):
+    '''
+    Looks key up in the cache and answers from it on a hit.
+    Returns (entry, outcome), with outcome 'sent' if the request was answered.
+    '''
+    entry, outcome = proxy_cache.lookup(key, request_headers)
+    if outcome == 'hit':
+        try:
+            send_cached(connection_socket, entry)
+            return entry, 'sent'
+        except FileNotFoundError:
+            proxy_cache.remove(key)  # evicted since the lookup
+            return None, 'miss'
+    return entry, outcome
+
+
+def forward(connection_socket, host, path, request_lines, key, request_headers, entry, download):
+    # ask the origin to keep the connection open for the next request to it, and for
+    # the full response so it can be cached: the client's own validators, ranges and
+    # accepted encodings are dropped
+    modified_request = f'GET {path} HTTP/1.1\r\n'
+    for line in request_lines:
+        name = line.split(':', 1)[0].strip().lower()
+        if name == 'host':
+            modified_request += f'Host: {host}\r\n'
+        elif (name not in hop_by_hop_headers and name not in conditional_headers
+              and name not in negotiation_headers):
+            modified_request += line + '\r\n'
+
+    # revalidate a stale entry instead of downloading it again
+    if entry is not None and entry.has_validators():
+        if entry.etag is not None:
+            modified_request += f'If-None-Match: {entry.etag}\r\n'
+        if entry.last_modified is not None:
+            modified_request += f'If-Modified-Since: {entry.last_modified}\r\n'
+    else:
+        entry = None
+    modified_request += 'Connection: keep-alive\r\n\r\n'
+
+    if not origin_limiter.acquire(host):
+        print(f'BUSY: Too many requests to {host}')
+        busy_msg = ('<h1>503 Service Unavailable</h1>'
+                    '<p>Too many requests to the requested server, try again later.</p>')
+        send_error(connection_socket, '503 Service Unavailable', busy_msg)
+        return
 
-                    # add headers
-                    response += f'Content-Type: text/html\r\n'
-                    response += f'Content-Length: {len(not_found_msg)}\r\n'
-                    response += '\r\n'
-                    connection_socket.sendall(response.encode() + not_found_msg.encode())
+    try:
+        fetch(connection_socket, host, modified_request, key, request_headers, entry, download)
+    except error:
+        not_found_msg = ('<h1>404 Not Found</h1>'
+                         '<p>Could not connect to the requested server.</p>')
+        send_error(connection_socket, '404 Not Found', not_found_msg)
+    finally:
+        origin_limiter.release(host)
 
+
+def handle_connection(connection_socket):
+    '''
+    Answers one client request, from the cache or from the origin server.
+    Runs on a worker thread, so a slow origin only holds up its own clients.
+    '''
+    try:
+        # an idle or stalled client must not hold a worker forever
+        connection_socket.settimeout(client_timeout)
+        # get request
+        request = connection_socket.recv(1024).decode()
+        if not request:
+            return
+
+        method, url, _ = request.split('\n')[0].split(' ')
+        if method != 'GET':  # only handle GET requests
+            return
+
+        host, path = parse_url(url)
+        request_lines = request.split('\r\n\r\n')[0].split('\r\n')[1:]
+        request_headers = parse_headers(request_lines)
+
+        key = host + path
+        entry, outcome = lookup(connection_socket, key, request_headers)
+        if outcome == 'sent':
+            return
+
+        # follow a download of the same URL already in progress rather than fetch it again
+        download = None
+        if outcome != 'bypass':
+            download, leader = downloads.join(key)
+            if not leader:
+                print(f'CACHE: COALESCED {key}')
+                if follow(connection_socket, download):
+                    return
+
+                # it was not shared, maybe it was revalidated or is not cacheable: fetch alone
+                download = None
+                entry, outcome = lookup(connection_socket, key, request_headers)
+                if outcome == 'sent':
+                    return
+
+        try:
+            forward(connection_socket, host, path, request_lines, key, request_headers, entry, download)
+        finally:
+            if download:
+                downloads.finish(key, download)
+    except (error, ValueError):
+        pass  # client went away or sent a malformed request
+    finally:
         connection_socket.close()
 
 
+def main():
+    parser = argparse.ArgumentParser(description='Caching HTTP proxy server')
+    parser.add_argument('-p', '--port', type=int, default=server_port)
+    parser.add_argument('-w', '--workers', type=int, default=max_workers,
+                        help='client connections handled at the same time')
+    parser.add_argument('-o', '--per-origin', type=int, default=max_per_origin,
+                        help='upstream fetches to one origin server at the same time')
+    parser.add_argument('-i', '--idle-per-origin', type=int, default=max_idle_per_host,
+                        help='idle keep-alive connections kept open to one origin server')
+    parser.add_argument('-c', '--cache-bytes', type=int, default=cache_max_bytes,
+                        help='disk budget of the response cache')
+    parser.add_argument('-d', '--dns-ttl', type=int, default=dns_ttl,
+                        help='seconds resolved origin addresses are cached for')
+    parser.add_argument('-b', '--backlog', type=int, default=max_backlog_connections,
+                        help='pending connections the kernel queues while all workers are busy')
+    args = parser.parse_args()
+
+    global origin_limiter, upstream_pool, proxy_cache, dns_cache
+    dns_cache = DnsCache(ttl=args.dns_ttl)
+    proxy_cache = ProxyCache(cache_dir, args.cache_bytes)
+    origin_limiter = OriginLimiter(args.per_origin)
+    upstream_pool = UpstreamPool(args.idle_per_origin)
+
+    proxy_socket = socket(AF_INET, SOCK_STREAM)
+    proxy_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    proxy_socket.bind(('', args.port))
+    proxy_socket.listen(args.backlog)
+
+    print(f'Proxy server listening to port {args.port} with {args.workers} workers')
+
+    # a free worker slot is taken before accepting, so extra connections wait in the backlog
+    workers = ThreadPoolExecutor(max_workers=args.workers)
+    free_workers = BoundedSemaphore(args.workers)
+
+    def serve(connection_socket):
+        try:
+            handle_connection(connection_socket)
+        finally:
+            free_workers.release()
+
+    # main server loop
+    try:
+        while True:
+            free_workers.acquire()
+
+            # wait for client connection
+            print('LISTENING: Waiting for a new connection...')
+            connection_socket, addr = proxy_socket.accept()
+            workers.submit(serve, connection_socket)
+    except KeyboardInterrupt:
+        print(f'Cache: {proxy_cache.stats()}')
+        proxy_cache.close()
+        print(f'Upstream connections: {upstream_pool.stats()}')
+        print(f'DNS cache: {dns_cache.stats()}')
+        upstream_pool.close()
+
+
 if __name__ == "__main__":
     main()
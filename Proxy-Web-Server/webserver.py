@@ -1,7 +1,33 @@
 from socket import *
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_to_datetime
+from threading import BoundedSemaphore, Lock
+import argparse
+import gzip
+import os
+import selectors
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # brotli is optional, gzip is always offered
 
 server_port = 8080
-max_backlog_connections = 1
+max_backlog_connections = 128
+max_workers = 16  # connections served at the same time
+keep_alive_timeout = 5  # seconds an idle persistent connection is kept open
+max_idle_connections = 1024  # idle connections watched at once, beyond that new ones wait in the backlog
+max_request_size = 16384  # largest request head accepted, in bytes
+sendfile_threshold = 16384  # files this size or larger are sent with sendfile instead of read
+cache_max_bytes = 32 * 1024 * 1024  # memory budget of the file cache, 0 disables it
+cache_validate_interval = 1  # seconds between mtime/size checks of a cached file
+compress_min_size = 256  # smaller files are sent as is, compressing them does not pay off
+compress_max_size = 4 * 1024 * 1024  # larger files are only sent compressed from a sidecar
+uncached_compress_max_size = 64 * 1024  # the same limit when the cache is disabled and every request compresses
+compress_level = 6
+brotli_quality = 5  # the default of 11 is far too slow to run per request
 
 content_types = {
     'html': 'text/html',
@@ -11,69 +37,707 @@ content_types = {
     'jpg': 'image/jpeg',
 }
 
+# only these are compressed, images are already compressed
+compressible_types = {'text/html', 'text/plain'}
+
+# content coding : (precompressed sidecar suffix, compress function), most preferred first
+encodings = {'gzip': ('.gz', lambda data: gzip.compress(data, compress_level, mtime=0))}
+if brotli:
+    encodings = {'br': ('.br', lambda data: brotli.compress(data, quality=brotli_quality)), **encodings}
+
+
+class CacheEntry:
+    __slots__ = ('content_type', 'content', 'mtime', 'size', 'checked_at', 'heads')
+
+    def __init__(self, content_type, content, mtime, size):
+        self.content_type = content_type
+        self.content = content
+        self.mtime = mtime  # of the file on disk it was read from, the sidecar for precompressed content
+        self.size = size
+        self.checked_at = time.monotonic()
+        self.heads = {}  # Connection header value : response head
+
+
+class FileCache:
+    '''
+    LRU cache of small files and their response heads, bounded by max_bytes of content.
+    Compressed versions of a file are cached next to it, keyed by content coding,
+    and precompressed sidecars under their own path. A cached file is checked against
+    its mtime and size at most once per validate_interval, as are the stats of
+    sidecars, so hot files are served without touching the filesystem.
+    '''
+
+    def __init__(self, max_bytes, validate_interval=cache_validate_interval):
+        self.max_bytes = max_bytes
+        self.validate_interval = validate_interval
+        self.entries = OrderedDict()  # (filename, encoding) : CacheEntry, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.file_stats = {}  # path : ((mtime, size) or None, checked at)
+        self.lock = Lock()
+
+    def get(self, filename, encoding=None):
+        key = (filename, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+
+        if time.monotonic() - entry.checked_at >= self.validate_interval:
+            try:
+                stat = os.stat(filename)
+                valid = stat.st_mtime_ns == entry.mtime and stat.st_size == entry.size
+            except OSError:
+                valid = False
+            if not valid:
+                self.remove(filename, encoding)
+                with self.lock:
+                    self.misses += 1
+                return None
+            entry.checked_at = time.monotonic()
+
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def stat(self, path):
+        # stat_file(path), looked up again at most once per validate_interval
+        now = time.monotonic()
+        with self.lock:
+            cached = self.file_stats.get(path)
+        if cached is not None and now - cached[1] < self.validate_interval:
+            return cached[0]
+        stat = stat_file(path)
+        with self.lock:
+            self.file_stats[path] = (stat, now)
+        return stat
+
+    def put(self, filename, content_type, content, mtime, size, encoding=None):
+        if len(content) > self.max_bytes:
+            return
+
+        key = (filename, encoding)
+        entry = CacheEntry(content_type, content, mtime, size)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.content)
+            self.entries[key] = entry
+            self.size += len(content)
 
-def create_http_response(status_code, content_type, content):
+            # evict least recently used files until back under budget
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.content)
+                self.evictions += 1
+
+    def remove(self, filename, encoding=None):
+        with self.lock:
+            entry = self.entries.pop((filename, encoding), None)
+            if entry is not None:
+                self.size -= len(entry.content)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'files': len(self.entries), 'bytes': self.size}
+
+
+file_cache = FileCache(cache_max_bytes)
+
+
+def create_http_head(status_code, content_type, content_length, headers=None):
     response = f'HTTP/1.1 {status_code}\r\n'
 
     # add headers
     response += f'Content-Type: {content_type}\r\n'
-    response += f'Content-Length: {len(content)}\r\n'
+    if content_length is not None:
+        response += f'Content-Length: {content_length}\r\n'
+    for name, value in (headers or {}).items():
+        response += f'{name}: {value}\r\n'
     response += '\r\n'
 
+    return response.encode()
+
+
+def create_http_response(status_code, content_type, content, headers=None):
     # encode to bytes if string
     if isinstance(content, str):
-        return response.encode() + content.encode()
+        content = content.encode()
 
-    return response.encode() + content
+    return create_http_head(status_code, content_type, len(content), headers) + content
 
 
-def send_http_response(request):
-    # parse HTTP request from client
+def parse_request(request):
+    # split an HTTP request head into its request line parts and a dict of lowercase headers
     request_lines = request.split('\r\n')
     request_line = request_lines[0]
-    method, path, _ = request_line.split()
+    method, path, version = request_line.split()
+
+    headers = {}
+    for line in request_lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    return method, path, version, headers
+
+
+def wants_keep_alive(version, headers):
+    # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only if asked to
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def make_etag(mtime, size, encoding=None):
+    # each content coding is a different representation with its own tag
+    if encoding:
+        return f'"{mtime:x}-{size:x}-{encoding}"'
+    return f'"{mtime:x}-{size:x}"'
+
+
+def choose_encoding(request_headers):
+    '''
+    Returns the content coding to send, picked from Accept-Encoding by q-value
+    with ties going to the more preferred coding, or None for no coding.
+    '''
+    accepted = {}
+    for item in request_headers.get('accept-encoding', '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        params = params.strip().replace(' ', '')
+        q = 1.0
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in encodings:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def can_compress(size):
+    # whether a file of this size is compressed here when it has no sidecar
+    return compress_min_size <= size <= (compress_max_size if file_cache else uncached_compress_max_size)
+
+
+def stat_file(path):
+    # (mtime, size) of a file, or None if there is none
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def find_sidecar(filename, encoding, mtime):
+    '''
+    Returns (path, (mtime, size)) of the precompressed sidecar of a file in a content
+    coding, or None if there is none at least as new as the file.
+    '''
+    path = filename + encodings[encoding][0]
+    stat = file_cache.stat(path) if file_cache else stat_file(path)
+    if stat is None or stat[0] < mtime:
+        return None  # a stale sidecar, the file changed after it was compressed
+    return path, stat
+
+
+def load_encoded(filename, encoding, content_type, content, mtime, size, sidecar=None):
+    '''
+    Returns (entry, content, file, length) of the file in a content coding, or None to
+    send it uncompressed. The sidecar found by find_sidecar is used if there is one,
+    else files of compress_min_size up to compress_max_size (uncached_compress_max_size
+    with the cache disabled) are compressed here. Either way small results are cached
+    so this happens once: sidecars under their own path, checked against the sidecar.
+    '''
+    if sidecar is not None:
+        path, stat = sidecar
+        entry = file_cache.get(path, encoding) if file_cache else None
+        if entry is not None:
+            return entry, entry.content, None, len(entry.content)
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        fstat = os.fstat(f.fileno())
+        if (fstat.st_mtime_ns, fstat.st_size) != stat:
+            f.close()  # replaced since it was found, its ETag no longer matches
+            return None
+        if fstat.st_size >= sendfile_threshold:
+            return None, None, f, fstat.st_size
+        with f:
+            encoded = f.read()
+        if file_cache and len(encoded) == fstat.st_size:
+            file_cache.put(path, content_type, encoded, fstat.st_mtime_ns, fstat.st_size, encoding)
+        return None, encoded, None, len(encoded)
+
+    entry = file_cache.get(filename, encoding) if file_cache else None
+    if entry is not None:
+        return entry, entry.content, None, len(entry.content)
+    if not can_compress(size):
+        return None
+
+    if content is None:
+        with open(filename, 'rb') as plain:
+            content = plain.read()
+    encoded = encodings[encoding][1](content)
+    if file_cache:
+        file_cache.put(filename, content_type, encoded, mtime, size, encoding)
+    return None, encoded, None, len(encoded)
+
+
+def not_modified(request_headers, etag, mtime):
+    '''
+    Returns true if the client's cached copy is current: If-None-Match lists our ETag,
+    or there is no If-None-Match and the file is not newer than If-Modified-Since.
+    '''
+    if 'if-none-match' in request_headers:
+        tags = [tag.strip() for tag in request_headers['if-none-match'].split(',')]
+        return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+    if 'if-modified-since' in request_headers:
+        try:
+            since = parsedate_to_datetime(request_headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return mtime // 1_000_000_000 <= since
+
+    return False
+
+
+def parse_range(request_headers, etag, last_modified, size):
+    '''
+    Returns the (first, last) byte positions asked for by a single range Range header,
+    None to send the whole file, or 'unsatisfiable'.
+    A Range with a stale If-Range, or with several ranges, is ignored.
+    '''
+    value = request_headers.get('range', '')
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+
+    if_range = request_headers.get('if-range')
+    if if_range is not None and if_range not in (etag, last_modified):
+        return None
+
+    first, dash, last = value[6:].strip().partition('-')
+    # plain digits only, int() would also take signs: bytes=--5 is not a suffix of -5 bytes
+    if not dash or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    try:
+        if first == '':
+            # suffix range: the last N bytes, of which an empty file has none
+            length = int(last)
+            if length == 0 or size == 0:
+                return 'unsatisfiable'
+            return max(size - length, 0), size - 1
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if first >= size or last < first:
+        return 'unsatisfiable'
+    return first, min(last, size - 1)
+
+
+def send_http_response(request, keep_alive=False):
+    '''
+    Builds the response to a request as a list of parts to send in order:
+    bytes, or a (file, offset, count) tuple sent with sendfile. The first part
+    is always the whole response head, so a HEAD request is answered with it alone.
+    Answers conditional requests with 304 and single range requests with 206.
+    Compressible types are sent in the best content coding the client accepts.
+    '''
+    # parse HTTP request from client
+    method, path, _, request_headers = parse_request(request)
     filename = path[1:]
+    connection = 'keep-alive' if keep_alive else 'close'
+    headers = {'Connection': connection}
 
     # default to HelloWorld.html if no file name
     if filename == '':
         filename = 'HelloWorld.html'
 
-    try:
-        # find the requested file in the server
-        with open(filename, 'rb') as f:
-            content = f.read()
+    # serve hot small files from memory
+    entry = file_cache.get(filename) if file_cache else None
+    f = None
+    if entry is not None:
+        content_type, content, mtime, size = entry.content_type, entry.content, entry.mtime, entry.size
+    else:
+        try:
+            # find the requested file in the server
+            f = open(filename, 'rb')
+        except (FileNotFoundError, IsADirectoryError):
+            not_found_msg = (b'<h1>404 Not Found</h1>'
+                             b'<p>The file requested was not found on the server.</p>')
+            return [create_http_head('404 Not Found', 'text/html', len(not_found_msg), headers), not_found_msg]
 
         extension = filename.split('.')[-1].lower()
 
         content_type = content_types.get(extension,
                                          'application/octet-stream')  # default to octet-stream for ext unknown to the server
-        return create_http_response('200 OK', content_type, content)
-    except FileNotFoundError:
-        not_found_msg = ('<h1>404 Not Found</h1>'
-                         '<p>The file requested was not found on the server.</p>')
-        return create_http_response('404 Not Found', 'text/html', not_found_msg)
+        stat = os.fstat(f.fileno())
+        mtime, size = stat.st_mtime_ns, stat.st_size
+        content = None
 
+        # small files are read (and cached), large ones go straight from the page cache
+        if size < sendfile_threshold:
+            with f:
+                content = f.read()
+            f = None
+            if file_cache and len(content) == size:
+                file_cache.put(filename, content_type, content, mtime, size)
 
-def main():
-    server_socket = socket(AF_INET, SOCK_STREAM)  # TCP socket
-    server_socket.bind(('', server_port))
-    server_socket.listen(max_backlog_connections)
-    print(f'Server listening to port {server_port}')
+    # the response now depends on Accept-Encoding, so shared caches must key on it
+    length = size
+    encoding = None
+    if content_type in compressible_types:
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = choose_encoding(request_headers)
+    sidecar = None
+    if encoding:
+        sidecar = find_sidecar(filename, encoding, mtime)
+        if sidecar is None and not can_compress(size):
+            encoding = None
 
-    # main server loop
+    # the validators do not depend on the compressed bytes, so a client with a current
+    # copy is answered before anything is compressed. A sidecar was compressed elsewhere,
+    # maybe differently, so it is tagged by its own mtime and size
+    if sidecar is not None:
+        etag = make_etag(*sidecar[1], encoding)
+    else:
+        etag = make_etag(mtime, size, encoding)
+    last_modified = formatdate(mtime / 1_000_000_000, usegmt=True)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    headers.update({'ETag': etag, 'Last-Modified': last_modified, 'Accept-Ranges': 'bytes'})
+
+    if not_modified(request_headers, etag, mtime):
+        if f:
+            f.close()
+        return [create_http_head('304 Not Modified', content_type, None, headers)]
+
+    if encoding:
+        encoded = load_encoded(filename, encoding, content_type, content, mtime, size, sidecar)
+        if encoded is None:
+            # the sidecar changed or went away since find_sidecar looked
+            encoding = None
+            del headers['Content-Encoding']
+            etag = headers['ETag'] = make_etag(mtime, size)
+        else:
+            if f:
+                f.close()
+            entry, content, f, length = encoded
+
+    byte_range = parse_range(request_headers, etag, last_modified, length)
+    if byte_range == 'unsatisfiable':
+        if f:
+            f.close()
+        headers['Content-Range'] = f'bytes */{length}'
+        return [create_http_head('416 Range Not Satisfiable', content_type, 0, headers)]
+
+    if byte_range is not None:
+        first, last = byte_range
+        headers['Content-Range'] = f'bytes {first}-{last}/{length}'
+        head = create_http_head('206 Partial Content', content_type, last - first + 1, headers)
+        if f:
+            return [head, (f, first, last - first + 1)]
+        return [head, memoryview(content)[first:last + 1]]
+
+    if entry is not None:
+        head = entry.heads.get(connection)
+        if head is None:
+            head = entry.heads[connection] = create_http_head('200 OK', content_type, length, headers)
+        return [head, content]
+
+    head = create_http_head('200 OK', content_type, length, headers)
+    if f:
+        return [head, (f, 0, length)]
+    return [head, content]
+
+
+def is_file_part(part):
+    return isinstance(part, tuple)
+
+
+def close_parts(parts):
+    for part in parts:
+        if is_file_part(part):
+            part[0].close()
+
+
+def send_parts(connection_socket, parts):
+    '''
+    Sends response parts: runs of bytes are joined into one sendall,
+    files are streamed with sendfile so their contents never enter user space.
+    '''
+    pending = []
+    try:
+        for part in parts:
+            if not is_file_part(part):
+                pending.append(part)
+                continue
+
+            if pending:
+                connection_socket.sendall(b''.join(pending))
+                pending = []
+            f, offset, count = part
+            connection_socket.sendfile(f, offset, count)
+
+        if pending:
+            connection_socket.sendall(b''.join(pending))
+    finally:
+        close_parts(parts)
+
+
+def read_request(connection_socket, buffer):
+    '''
+    Reads one request head from the connection into buffer and removes it from there.
+    Bytes after it (pipelined requests) stay in buffer for the next call.
+    Returns None if the client closed the connection, raises ValueError
+    if the head is larger than max_request_size.
+    '''
     while True:
-        # wait for a client connection
-        connection_socket, addr = server_socket.accept()
+        end = buffer.find(b'\r\n\r\n', 0, max_request_size + 4)
+        if end != -1:
+            request = bytes(buffer[:end])
+            del buffer[:end + 4]
+            return request.decode('iso-8859-1')
+
+        if len(buffer) > max_request_size:
+            raise ValueError('request head too large')
+
+        data = connection_socket.recv(4096)
+        if not data:
+            return None
+        buffer += data
+
+
+def discard_body(connection_socket, buffer, headers):
+    # skip a request body so the next pipelined request lines up
+    length = headers.get('content-length', '0')
+    if not length.isdigit():
+        raise ValueError(f'bad Content-Length {length!r}')
+    length = int(length)
+    while len(buffer) < length:
+        data = connection_socket.recv(4096)
+        if not data:
+            break
+        buffer += data
+    del buffer[:length]
+
+
+class IdleConnections:
+    '''
+    Connections waiting for their next request, watched by one selector instead of
+    holding a worker each. New connections start here too. ready() returns the ones
+    a request arrived on, and connections idle for timeout seconds are closed.
+    '''
 
-        # get request
-        request = connection_socket.recv(1024).decode()
+    def __init__(self, server_socket, timeout=keep_alive_timeout, max_idle=max_idle_connections):
+        self.server_socket = server_socket
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.selector = selectors.DefaultSelector()
+        self.deadlines = OrderedDict()  # socket : time it is closed at, soonest first
+        self.parked = deque()  # (socket, buffer) handed back by workers, registered by ready()
+        self.lock = Lock()
 
-        # handle request
-        if request:
-            response = send_http_response(request)
-            connection_socket.sendall(response)
+        # workers wake the selector up through this pair when they park a connection
+        self.wakeup_recv, self.wakeup_send = socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.selector.register(server_socket, selectors.EVENT_READ)
+        self.accepting = True
 
-        connection_socket.close()
+    def park(self, connection_socket, buffer):
+        # called by a worker done with the requests buffered on a persistent connection
+        with self.lock:
+            self.parked.append((connection_socket, buffer))
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass  # a wakeup is already pending
+
+    def watch(self, connection_socket, buffer):
+        self.selector.register(connection_socket, selectors.EVENT_READ, buffer)
+        self.deadlines[connection_socket] = time.monotonic() + self.timeout
+
+    def unwatch(self, connection_socket):
+        self.selector.unregister(connection_socket)
+        del self.deadlines[connection_socket]
+
+    def ready(self):
+        '''
+        Waits until requests arrive and returns their (socket, buffer) pairs,
+        which are no longer watched. Accepts new connections meanwhile.
+        '''
+        while True:
+            timeout = None
+            if self.deadlines:
+                timeout = max(next(iter(self.deadlines.values())) - time.monotonic(), 0)
+
+            ready = []
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wakeup_recv:
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj is self.server_socket:
+                    connection_socket, _ = self.server_socket.accept()
+                    connection_socket.settimeout(self.timeout)
+                    self.watch(connection_socket, bytearray())
+                else:
+                    self.unwatch(key.fileobj)
+                    ready.append((key.fileobj, key.data))
+
+            with self.lock:
+                parked, self.parked = self.parked, deque()
+            for connection_socket, buffer in parked:
+                self.watch(connection_socket, buffer)
+
+            # close connections that stayed idle too long, the oldest are first
+            now = time.monotonic()
+            while self.deadlines:
+                connection_socket, deadline = next(iter(self.deadlines.items()))
+                if deadline > now:
+                    break
+                self.unwatch(connection_socket)
+                connection_socket.close()
+
+            # too many idle connections: leave new ones in the backlog for now
+            if self.accepting and len(self.deadlines) >= self.max_idle:
+                self.selector.unregister(self.server_socket)
+                self.accepting = False
+            elif not self.accepting and len(self.deadlines) < self.max_idle:
+                self.selector.register(self.server_socket, selectors.EVENT_READ)
+                self.accepting = True
+
+            if ready:
+                return ready
+
+
+def handle_connection(connection_socket, buffer, park):
+    '''
+    Serves the requests arriving on a connection until none is left in buffer, then
+    hands a persistent connection to park to wait for the next one without holding
+    a worker, or closes it. Responses to pipelined requests that are already
+    buffered are sent together.
+    '''
+    responses = []
+    parked = False
+    try:
+        while True:
+            try:
+                request = read_request(connection_socket, buffer)
+            except ValueError:
+                too_large_msg = '<h1>431 Request Header Fields Too Large</h1>'
+                responses.append(create_http_response('431 Request Header Fields Too Large', 'text/html',
+                                                      too_large_msg, {'Connection': 'close'}))
+                break
+            if request is None:
+                break
+
+            try:
+                method, path, version, headers = parse_request(request)
+                discard_body(connection_socket, buffer, headers)
+            except ValueError:
+                bad_request_msg = '<h1>400 Bad Request</h1>'
+                responses.append(create_http_response('400 Bad Request', 'text/html',
+                                                      bad_request_msg, {'Connection': 'close'}))
+                break
+
+            if method not in ('GET', 'HEAD'):
+                not_allowed_msg = '<h1>405 Method Not Allowed</h1>'
+                responses.append(create_http_response('405 Method Not Allowed', 'text/html', not_allowed_msg,
+                                                      {'Allow': 'GET, HEAD', 'Connection': 'close'}))
+                break
+
+            keep_alive = wants_keep_alive(version, headers)
+            parts = send_http_response(request, keep_alive)
+            if method == 'HEAD':
+                # same head as a GET, no body
+                close_parts(parts[1:])
+                parts = parts[:1]
+            responses += parts
+            if not keep_alive:
+                break
+
+            # answer everything buffered in one go once no complete request is left
+            if b'\r\n\r\n' not in buffer:
+                send_parts(connection_socket, responses)
+                responses = []
+                park(connection_socket, buffer)
+                parked = True
+                return
+
+        if responses:
+            send_parts(connection_socket, responses)
+    except OSError:
+        pass  # client went away or stalled part way through a request
+    finally:
+        close_parts(responses)
+        if not parked:
+            connection_socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Static file web server')
+    parser.add_argument('-p', '--port', type=int, default=server_port)
+    parser.add_argument('-w', '--workers', type=int, default=max_workers,
+                        help='connections served at the same time')
+    parser.add_argument('-b', '--backlog', type=int, default=max_backlog_connections,
+                        help='pending connections the kernel queues while all workers are busy')
+    parser.add_argument('-c', '--cache-bytes', type=int, default=cache_max_bytes,
+                        help='memory budget for cached small files, 0 to disable the cache')
+    args = parser.parse_args()
+
+    global file_cache
+    file_cache = FileCache(args.cache_bytes) if args.cache_bytes > 0 else None
+
+    server_socket = socket(AF_INET, SOCK_STREAM)  # TCP socket
+    server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server_socket.bind(('', args.port))
+    server_socket.listen(args.backlog)
+    print(f'Server listening to port {args.port} with {args.workers} workers')
+
+    # workers only get connections a request arrived on, idle ones wait in the selector
+    workers = ThreadPoolExecutor(max_workers=args.workers)
+    free_workers = BoundedSemaphore(args.workers)
+    idle = IdleConnections(server_socket)
+
+    def serve(connection_socket, buffer):
+        try:
+            handle_connection(connection_socket, buffer, idle.park)
+        finally:
+            free_workers.release()
+
+    # main server loop
+    try:
+        while True:
+            for connection_socket, buffer in idle.ready():
+                free_workers.acquire()
+                workers.submit(serve, connection_socket, buffer)
+    except KeyboardInterrupt:
+        if file_cache:
+            print(f'File cache: {file_cache.stats()}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+'''
+Benchmarks the transport's session table as the number of connected clients grows.
+Every simulated client leaves a message half received, then complete messages are
+pushed through random sessions and timed. Reports memory per session, latency per
+message and the memory left after idle sessions are evicted.
+'''
+import argparse
+import random
+import socket
+import time
+import tracemalloc
+import util
+
+
+def client_addr(i):
+    # a distinct loopback address per simulated client
+    return ("127.%d.%d.%d" % (1 + (i >> 16), (i >> 8) & 255, i & 255), 40000)
+
+
+def message_packets(seqno, payload):
+    chunks = [payload[i:i + util.CHUNK_SIZE] for i in range(0, len(payload), util.CHUNK_SIZE)]
+    packets = [util.encode_packet("start", seqno)]
+    for i, chunk in enumerate(chunks):
+        packets.append(util.encode_packet("data", seqno + 1 + i, chunk))
+    packets.append(util.encode_packet("end", seqno + len(chunks) + 1))
+    return packets
+
+
+def run(num_clients, num_messages):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    transport = util.Transport(sock)  # reader not started, datagrams are fed in directly
+    payload = util.make_message("send_message", 4, "1 bob " + "x" * 1000).encode()
+
+    tracemalloc.start()
+    base_mem = tracemalloc.get_traced_memory()[0]
+
+    # every client is in the middle of sending a message
+    seqnos = {}
+    for i in range(num_clients):
+        addr = client_addr(i)
+        seqnos[addr] = random.randint(1, 100000)
+        packets = message_packets(seqnos[addr], payload)
+        for packet in packets[:-1]:
+            transport.handle_datagram(packet, addr)
+    session_mem = tracemalloc.get_traced_memory()[0] - base_mem
+
+    # time complete messages through random sessions
+    addrs = list(seqnos)
+    latencies = []
+    for _ in range(num_messages):
+        addr = random.choice(addrs)
+        seqnos[addr] += 100
+        packets = message_packets(seqnos[addr], payload)
+        started = time.perf_counter()
+        for packet in packets:
+            transport.handle_datagram(packet, addr)
+        transport.messages.get_nowait()
+        latencies.append(time.perf_counter() - started)
+
+    # everyone goes quiet
+    del seqnos, addrs
+    transport.sessions.idle_timeout = 0
+    evicted = transport.sessions.evict_idle()
+    evicted_mem = tracemalloc.get_traced_memory()[0] - base_mem
+    tracemalloc.stop()
+    transport.close()
+
+    latencies.sort()
+    return {
+        "clients": num_clients,
+        "bytes_per_session": session_mem / num_clients,
+        "p50_us": latencies[len(latencies) // 2] * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6,
+        "evicted": evicted,
+        "bytes_after_eviction": evicted_mem,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-c", "--clients", type=int, nargs="+", default=[10, 100, 1000, 5000],
+                        help="numbers of connected clients to measure")
+    parser.add_argument("-m", "--messages", type=int, default=2000,
+                        help="complete messages timed per run")
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'bytes/session':>14} {'p50 us':>8} {'p99 us':>8} "
+          f"{'evicted':>8} {'bytes left':>11}")
+    for num_clients in args.clients:
+        res = run(num_clients, args.messages)
+        print(f"{res['clients']:>8} {res['bytes_per_session']:>14.0f} {res['p50_us']:>8.1f} "
+              f"{res['p99_us']:>8.1f} {res['evicted']:>8} {res['bytes_after_eviction']:>11}")
+
+
+if __name__ == "__main__":
+    main()
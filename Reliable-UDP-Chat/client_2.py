@@ -5,6 +5,7 @@ import sys
 import getopt
 import socket
 import random
+import signal
 from threading import Thread
 import os
 import util
@@ -26,13 +27,13 @@ class Client:
         self.server_addr = dest
         self.server_port = port
         self.send_addr = (self.server_addr, self.server_port)
+        self.window = window_size
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(None)
         self.sock.bind(('', random.randint(10000, 40000)))
         self.name = username
-        self.buffers = {}  # addr : {"chunks": [], "expected": seq}
+        self.transport = util.Transport(self.sock).start()
         self.next_seq = None
-        self.started = False
 
     def start(self):
         '''
@@ -46,9 +47,8 @@ class Client:
 
         # send join message to server
         init_seq = random.randint(1, 100000)
-        util.reliable_send_msg(self.sock, "join", 1, self.send_addr, init_seq, message=self.name)
-        self.next_seq = init_seq + 1
-        self.started = True
+        self.next_seq = util.reliable_send_msg(self.transport, "join", 1, self.send_addr, init_seq,
+                                               message=self.name, window=self.window)
         while True:
             # get user input
             msg = input()
@@ -68,6 +68,7 @@ class Client:
             self.help()
         elif cmd == "quit":
             self.quit()
+            self.transport.close()
             sys.exit(0)
         else:
             print("incorrect userinput format")
@@ -76,14 +77,10 @@ class Client:
         '''
         Waits for a message from server and process it accordingly
         '''
-        while True:
-            if not self.started:
-                continue
-
-            message, _, next_seq = util.receive_msg(self.sock, self.buffers)
+        while not self.transport.closed.is_set():
+            message, _, _ = self.transport.receive()
             # send message received from packets to handler
             if message:
-                self.next_seq = next_seq
                 self.handle_server_msg(message)
 
     def handle_server_msg(self, message):
@@ -97,13 +94,18 @@ class Client:
             self.fwd_message(msg_parts)
         elif res == "err_username_unavailable":
             print("disconnected: username not available")
-            sys.exit(0)
+            self.disconnect()
         elif res == "err_server_full":
             print("disconnected: server full")
-            sys.exit(0)
+            self.disconnect()
         elif res == "err_unknown_message":
             print("disconnected: server received an unknown command")
-            sys.exit(0)
+            self.disconnect()
+
+    def disconnect(self):
+        # server dropped us: stop the transport and interrupt the main thread blocked on input()
+        self.transport.close()
+        os.kill(os.getpid(), signal.SIGINT)
 
     def chat(self, msg_parts):
         # ensure correct formatting
@@ -128,13 +130,14 @@ class Client:
 
         # send msg to server
         msg_formatted = f"{num_recv} {' '.join(recipients)} {message}"
-        util.reliable_send_msg(self.sock, "send_message", 4, self.send_addr,
-                               self.next_seq, message=msg_formatted)
+        self.next_seq = util.reliable_send_msg(self.transport, "send_message", 4, self.send_addr,
+                                               self.next_seq, message=msg_formatted,
+                                               window=self.window)
 
     def list(self):
         # provie user with list of connected users
-        util.reliable_send_msg(self.sock, "request_users_list", 2,
-                               self.send_addr, self.next_seq)
+        self.next_seq = util.reliable_send_msg(self.transport, "request_users_list", 2,
+                                               self.send_addr, self.next_seq, window=self.window)
 
     def help(self):
         # provide user with list of commands
@@ -146,8 +149,9 @@ class Client:
 
     def quit(self):
         # send quit message
-        util.reliable_send_msg(self.sock, "disconnect", 1,
-                               self.send_addr, self.next_seq, message=self.name)
+        self.next_seq = util.reliable_send_msg(self.transport, "disconnect", 1, self.send_addr,
+                                               self.next_seq, message=self.name,
+                                               window=self.window)
         print("quitting")
 
     def users_list_res(self, msg_parts):
@@ -181,7 +185,7 @@ if __name__ == "__main__":
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "u:p:a:w", ["user=", "port=", "address=", "window="])
+                                   "u:p:a:w:", ["user=", "port=", "address=", "window="])
     except getopt.error:
         helper()
         exit(1)
@@ -198,7 +202,7 @@ if __name__ == "__main__":
         elif o in ("-a", "--address="):
             DEST = a
         elif o in ("-w", "--window="):
-            WINDOW_SIZE = a
+            WINDOW_SIZE = int(a)
 
     if USER_NAME is None:
         print("Missing Username.")
@@ -0,0 +1,115 @@
+'''
+Lossy link emulator for testing the reliable transport.
+LossySocket wraps a UDP socket and impairs every datagram sent through it:
+loss, delay with jitter, reordering, duplication and bit flip corruption.
+Install it for every util.Transport with
+
+    util.LINK_MODEL = linkemu.link_model(loss=0.05, delay=0.01)
+'''
+import heapq
+import itertools
+import random
+import time
+from threading import Condition, Lock, Thread
+
+
+class LossySocket:
+    '''
+    A UDP socket whose sendto() goes through an impaired link.
+    Anything other than sendto() and close() is passed to the wrapped socket.
+    '''
+
+    def __init__(self, sock, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=0.01,
+                 duplicate=0.0, corrupt=0.0, seed=None):
+        self.sock = sock
+        self.loss = loss  # probability a datagram is dropped
+        self.delay = delay  # seconds added to every datagram
+        self.jitter = jitter  # up to this many extra seconds, uniformly
+        self.reorder = reorder  # probability a datagram is held back by reorder_delay
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate  # probability a datagram is sent twice
+        self.corrupt = corrupt  # probability one bit of a datagram is flipped
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.stats = {"sent": 0, "dropped": 0, "delayed": 0, "reordered": 0,
+                      "duplicated": 0, "corrupted": 0}
+
+        self.queue = []  # heap of (due, order, packet, addr)
+        self.order = itertools.count()
+        self.queue_cond = Condition()
+        self.closed = False
+        self.scheduler = None
+        if delay or jitter or reorder:
+            self.scheduler = Thread(target=self.schedule_loop, daemon=True)
+            self.scheduler.start()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendto(self, packet, addr):
+        with self.lock:
+            self.stats["sent"] += 1
+            if self.random.random() < self.loss:
+                self.stats["dropped"] += 1
+                return len(packet)
+            copies = 1
+            if self.random.random() < self.duplicate:
+                self.stats["duplicated"] += 1
+                copies = 2
+            if self.random.random() < self.corrupt:
+                self.stats["corrupted"] += 1
+                packet = self.flip_bit(packet)
+            wait = self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                self.stats["reordered"] += 1
+                wait += self.reorder_delay
+            if self.scheduler is not None:
+                self.stats["delayed"] += copies
+
+        for _ in range(copies):
+            if self.scheduler is None:
+                self.sock.sendto(packet, addr)
+            else:
+                self.send_later(packet, addr, wait)
+        return len(packet)
+
+    def flip_bit(self, packet):
+        packet = bytearray(packet)
+        bit = self.random.randrange(len(packet) * 8)
+        packet[bit // 8] ^= 1 << (bit % 8)
+        return bytes(packet)
+
+    def send_later(self, packet, addr, wait):
+        with self.queue_cond:
+            heapq.heappush(self.queue, (time.monotonic() + wait, next(self.order), packet, addr))
+            self.queue_cond.notify()
+
+    def schedule_loop(self):
+        # send queued datagrams once they are due
+        while True:
+            with self.queue_cond:
+                while not self.closed and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.queue_cond.wait(timeout)
+                if self.closed:
+                    return
+                _, _, packet, addr = heapq.heappop(self.queue)
+            try:
+                self.sock.sendto(packet, addr)
+            except ConnectionError:
+                continue
+            except OSError:
+                return  # socket was closed
+
+    def close(self):
+        with self.queue_cond:
+            self.closed = True
+            self.queue_cond.notify()
+        self.sock.close()
+
+
+def link_model(**impairments):
+    '''
+    Returns a util.LINK_MODEL that wraps each socket in a LossySocket with these impairments
+    '''
+    return lambda sock: LossySocket(sock, **impairments)
@@ -0,0 +1,288 @@
+'''
+Load generator for the chat servers.
+Starts a server and N simulated clients in-process. Each client joins, then sends
+chat messages to random other clients (and now and then asks for the users list)
+at a set total rate, and finally disconnects. Reports messages/sec delivered and
+p50/p99 end-to-end latency, for the part 1 server (server_1.py, no acks) and the
+reliable server (server_2.py) at each window size, side by side.
+Every socket can be put behind an emulated lossy link (see linkemu.py) to measure
+goodput and retransmissions under loss, delay, reordering and corruption.
+'''
+import argparse
+import io
+import itertools
+import random
+import socket
+import time
+from contextlib import redirect_stdout
+from threading import Event, Lock, Thread
+import util
+import linkemu
+import server_1
+import server_2
+
+
+class Stats:
+    '''
+    Counters and latency samples shared by every simulated client
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sent_times = {}  # message id : time sent
+        self.latencies = []
+        self.sent = 0
+        self.lists = 0
+
+    def message_sent(self, msg_id):
+        with self.lock:
+            self.sent_times[msg_id] = time.perf_counter()
+            self.sent += 1
+
+    def message_received(self, msg_id):
+        now = time.perf_counter()
+        with self.lock:
+            sent_at = self.sent_times.pop(msg_id, None)
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+
+
+class SimClient:
+    '''
+    A scripted chat client. Subclasses provide send() and next_message().
+    '''
+    msg_ids = itertools.count()
+
+    def __init__(self, name, server_addr, stats, link=None):
+        self.name = name
+        self.server_addr = server_addr
+        self.stats = stats
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        if link:
+            self.sock = link(self.sock)
+
+    def join(self):
+        self.send("join", 1, self.name)
+        Thread(target=self.receive_loop, daemon=True).start()
+
+    def chat(self, recipient, padding):
+        msg_id = next(self.msg_ids)
+        self.stats.message_sent(msg_id)
+        self.send("send_message", 4, f"1 {recipient} {msg_id} {padding}")
+
+    def request_users_list(self):
+        self.send("request_users_list", 2)
+        with self.stats.lock:
+            self.stats.lists += 1
+
+    def disconnect(self):
+        self.send("disconnect", 1, self.name)
+
+    def receive_loop(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            msg_parts = message.split()
+            if msg_parts[0] == "forward_message":
+                # forward_message <len> 1 <sender> <msg id> <padding>
+                self.stats.message_received(int(msg_parts[4]))
+
+
+class BasicSimClient(SimClient):
+    '''
+    Part 1 client: one unacknowledged text packet per message
+    '''
+
+    def send(self, msg_type, msg_format, message=None):
+        util.send_msg(self.sock, msg_type, msg_format, self.server_addr, message)
+
+    def next_message(self):
+        while True:
+            try:
+                packet, _ = self.sock.recvfrom(4096)
+            except OSError:
+                return None
+            packet = packet.decode(errors="replace")
+            if util.validate_checksum(packet):
+                _, _, data, _ = util.parse_packet(packet)
+                return data
+
+    def close(self):
+        self.sock.close()
+
+
+class ReliableSimClient(SimClient):
+    '''
+    Part 2 client: messages go through the reliable windowed transport
+    '''
+
+    def __init__(self, name, server_addr, stats, window):
+        super().__init__(name, server_addr, stats)
+        self.window = window
+        self.transport = util.Transport(self.sock).start()  # wrapped by util.LINK_MODEL
+        self.next_seq = random.randint(1, 100000)
+
+    def send(self, msg_type, msg_format, message=None):
+        self.next_seq = util.reliable_send_msg(self.transport, msg_type, msg_format,
+                                               self.server_addr, self.next_seq, message,
+                                               window=self.window)
+
+    def next_message(self):
+        message, _, _ = self.transport.receive()
+        return message
+
+    def close(self):
+        self.transport.close()
+
+
+def client_loop(client, names, interval, list_ratio, padding, stop):
+    # send at a fixed pace until stop is set
+    next_send = time.perf_counter()
+    while not stop.is_set():
+        if random.random() < list_ratio:
+            client.request_users_list()
+        else:
+            recipient = random.choice([name for name in names if name != client.name])
+            client.chat(recipient, padding)
+
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            stop.wait(delay)
+
+
+def run(server, window, args):
+    '''
+    Runs one load test against server "1" or "2" and returns its results
+    '''
+    stats = Stats()
+    util.MAX_NUM_CLIENTS = max(util.MAX_NUM_CLIENTS, args.clients)
+
+    # every impaired socket, to add up their counters afterwards
+    links = []
+    link = None
+    if args.loss or args.delay or args.jitter or args.reorder or args.duplicate or args.corrupt:
+        model = linkemu.link_model(loss=args.loss, delay=args.delay, jitter=args.jitter,
+                                   reorder=args.reorder, duplicate=args.duplicate,
+                                   corrupt=args.corrupt)
+
+        def link(sock):
+            links.append(model(sock))
+            return links[-1]
+    util.LINK_MODEL = link
+
+    if server == "1":
+        srv = server_1.Server("127.0.0.1", 0, window)
+        server_addr = srv.sock.getsockname()
+        if link:
+            srv.sock = link(srv.sock)
+        Thread(target=srv.start, daemon=True).start()
+    else:
+        srv = server_2.Server("127.0.0.1", 0, window)
+        server_addr = srv.sock.getsockname()
+        srv.launch()
+
+    names = [f"client{i}" for i in range(args.clients)]
+    if server == "1":
+        clients = [BasicSimClient(name, server_addr, stats, link) for name in names]
+    else:
+        clients = [ReliableSimClient(name, server_addr, stats, window) for name in names]
+    for client in clients:
+        client.join()
+    time.sleep(0.2)  # let the server register everyone
+
+    stop = Event()
+    interval = args.clients / args.rate if args.rate else 0
+    padding = "x" * args.size
+    threads = [Thread(target=client_loop, daemon=True,
+                      args=(client, names, interval, args.list_ratio, padding, stop))
+               for client in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    time.sleep(args.grace)  # let in-flight messages arrive
+    retransmits = 0
+    if server == "2":
+        transports = [srv.transport] + [client.transport for client in clients]
+        retransmits = sum(transport.stats["retransmits"] for transport in transports)
+    dropped = sum(sock.stats["dropped"] for sock in links)
+    corrupted = sum(sock.stats["corrupted"] for sock in links)
+
+    for client in clients:
+        client.disconnect()
+        client.close()
+    if server == "2":
+        srv.stop()
+    util.LINK_MODEL = None
+
+    latencies = sorted(stats.latencies)
+    return {
+        "server": f"server_{server}",
+        "window": window if server == "2" else "-",
+        "sent": stats.sent,
+        "delivered": len(latencies),
+        "lists": stats.lists,
+        "msgs_per_sec": len(latencies) / elapsed,
+        "goodput_kbps": len(latencies) * args.size / elapsed / 1024,
+        "retransmits": retransmits,
+        "dropped": dropped,
+        "corrupted": corrupted,
+        "p50_ms": latencies[len(latencies) // 2] * 1e3 if latencies else float("nan"),
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1e3 if latencies else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--clients", type=int, default=10, help="simulated clients")
+    parser.add_argument("-r", "--rate", type=float, default=200,
+                        help="total messages/sec across all clients, 0 for as fast as possible")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="seconds of load")
+    parser.add_argument("-s", "--size", type=int, default=100, help="message body bytes")
+    parser.add_argument("-l", "--list-ratio", type=float, default=0.05,
+                        help="fraction of requests that ask for the users list")
+    parser.add_argument("-g", "--grace", type=float, default=1,
+                        help="seconds to wait for in-flight messages after the load stops")
+    parser.add_argument("--loss", type=float, default=0, help="link loss probability")
+    parser.add_argument("--delay", type=float, default=0, help="link one-way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0, help="link jitter in seconds")
+    parser.add_argument("--reorder", type=float, default=0,
+                        help="probability a datagram is held back and reordered")
+    parser.add_argument("--duplicate", type=float, default=0,
+                        help="probability a datagram is duplicated")
+    parser.add_argument("--corrupt", type=float, default=0,
+                        help="probability a datagram has a bit flipped")
+    parser.add_argument("--servers", nargs="+", choices=["1", "2"], default=["1", "2"],
+                        help="servers to run")
+    parser.add_argument("-w", "--windows", type=int, nargs="+", default=[1, 3],
+                        help="window sizes to run server_2 with")
+    args = parser.parse_args()
+
+    runs = [(server, window) for server in args.servers
+            for window in (args.windows if server == "2" else [1])]
+    results = []
+    for server, window in runs:
+        # keep the servers' per-message prints out of the report
+        with redirect_stdout(io.StringIO()):
+            results.append(run(server, window, args))
+
+    print(f"{'server':>9} {'window':>6} {'sent':>7} {'delivered':>9} {'lists':>6} "
+          f"{'msgs/sec':>9} {'KB/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'retx':>6} "
+          f"{'dropped':>7} {'corrupt':>7}")
+    for res in results:
+        print(f"{res['server']:>9} {res['window']:>6} {res['sent']:>7} {res['delivered']:>9} "
+              f"{res['lists']:>6} {res['msgs_per_sec']:>9.1f} {res['goodput_kbps']:>8.1f} "
+              f"{res['p50_ms']:>8.2f} {res['p99_ms']:>8.2f} {res['retransmits']:>6} "
+              f"{res['dropped']:>7} {res['corrupted']:>7}")
+
+
+if __name__ == "__main__":
+    main()
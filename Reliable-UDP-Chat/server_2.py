@@ -4,9 +4,69 @@ This module defines the behaviour of server in your Chat Application
 import sys
 import getopt
 import socket
+import random
+import bisect
 import util
-from queue import Queue
-from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, RLock, Event
+
+
+class ClientRegistry:
+    '''
+    Connected clients indexed both by username and by address.
+    The sorted username list is updated in place on every add/remove
+    so listing users never re-sorts.
+    '''
+
+    def __init__(self):
+        self.addrs = {}  # username : addr
+        self.names = {}  # addr : username
+        self.sorted_names = []
+        self.users_list_str = None  # cached users list response, None when stale
+        self.lock = RLock()  # send workers remove clients that stop acknowledging
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __contains__(self, username):
+        return username in self.addrs
+
+    def add(self, username, addr):
+        with self.lock:
+            # an address can only be joined under one name
+            old_name = self.names.get(addr)
+            if old_name is not None:
+                self.remove(old_name)
+
+            self.addrs[username] = addr
+            self.names[addr] = username
+            bisect.insort(self.sorted_names, username)
+            self.users_list_str = None
+
+    def remove(self, username):
+        with self.lock:
+            addr = self.addrs.pop(username, None)
+            if addr is None:
+                return None
+
+            del self.names[addr]
+            del self.sorted_names[bisect.bisect_left(self.sorted_names, username)]
+            self.users_list_str = None
+            return addr
+
+    def get_addr(self, username):
+        return self.addrs.get(username)
+
+    def get_name(self, addr):
+        return self.names.get(addr)
+
+    def users_list(self):
+        # "<count> <name1> <name2> ..." in sorted order
+        with self.lock:
+            if self.users_list_str is None:
+                self.users_list_str = f"{len(self.sorted_names)} {' '.join(self.sorted_names)}"
+            return self.users_list_str
 
 
 class Server:
@@ -17,46 +77,55 @@ class Server:
     def __init__(self, dest, port, window):
         self.server_addr = dest
         self.server_port = port
+        self.window = window
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.settimeout(None)
         self.sock.bind((self.server_addr, self.server_port))
 
-        self.clients = {}  # username : addr
-        self.buffers = {}  # addr : {"chunks": [], "expected": seq}
-        self.clients_seq = {}  # addr : next seq num
-        self.msg_queue = Queue()
-
+        self.clients = ClientRegistry()
+        self.transport = util.Transport(self.sock)
+        self.outboxes = {}  # addr : deque of messages waiting to be sent to addr
+        self.outboxes_lock = Lock()
+        self.pool = ThreadPoolExecutor(max_workers=util.SEND_WORKERS)
+        self.stopped = Event()
 
     def start(self):
         '''
-        Launch receiver and main loop threads.
-        Receiver thread listens for packets being sent and places them in the queue.
-        Main loop handles messages in the queue.
+        Launch the server threads and block until stop() or keyboard interrupt.
+        The main thread sleeps on an event instead of spinning.
         '''
-
-        # start recv and message loops
-        Thread(target=self.recv_loop, daemon=True).start()
-        Thread(target=self.message_loop, daemon=True).start()
-
-        # keep main thread alive until keyboard interrupt
+        self.launch()
         try:
-            while True:
-                pass
+            self.stopped.wait()
         except KeyboardInterrupt:
-            sys.exit(0)
+            pass
+        finally:
+            self.stop()
 
-    def recv_loop(self):
-        while True:
-            message, addr, next_seq = util.receive_msg(self.sock, self.buffers)
-            if message and addr:
-                self.clients_seq[addr] = next_seq
-                self.msg_queue.put((message, addr))
+    def launch(self):
+        '''
+        Launch the transport reader and main loop threads and return.
+        The transport owns the socket and queues every complete message.
+        Main loop handles messages in the queue.
+        '''
+        self.transport.start()
+        Thread(target=self.message_loop, daemon=True).start()
+
+    def stop(self):
+        '''
+        Shut down the server: wake and stop the transport, drop queued sends
+        and wait for in-flight sends to give up.
+        '''
+        self.stopped.set()
+        self.transport.close()
+        self.pool.shutdown(wait=True, cancel_futures=True)
 
     def message_loop(self):
-        while True:
-            message, addr = self.msg_queue.get()
-            self.handle_message(message, addr)
+        while not self.stopped.is_set():
+            message, addr, _ = self.transport.receive()
+            if message:
+                self.handle_message(message, addr)
 
     def handle_message(self, message, addr):
         # extract command and handle accordingly
@@ -76,24 +145,65 @@ class Server:
 
     def unknown_cmd(self, addr):
         # get username from address
-        username = None
-        for name, stored_addr in self.clients.items():
-            if stored_addr == addr:
-                username = name
+        username = self.clients.get_name(addr)
 
         if username:
-            util.reliable_send_msg(self.sock, "err_unknown_message", 2, addr,
-                                   self.clients_seq[addr])
+            self.send(addr, "err_unknown_message", 2)
             # disconnect client
-            del self.clients[username]
+            self.clients.remove(username)
             print(f"disconnected: {username} sent unknown command")
 
+    def send(self, addr, msg_type, msg_format, message=None):
+        '''
+        Queues a message for addr and returns without waiting for acks.
+        Each client has its own outbox drained by one pool worker at a time,
+        so clients are served concurrently and each one in order.
+        '''
+        with self.outboxes_lock:
+            outbox = self.outboxes.get(addr)
+            idle = outbox is None
+            if idle:
+                outbox = self.outboxes[addr] = deque()
+            outbox.append((msg_type, msg_format, message))
+
+        if idle:
+            self.pool.submit(self.drain_outbox, addr)
+
+    def drain_outbox(self, addr):
+        while True:
+            with self.outboxes_lock:
+                outbox = self.outboxes[addr]
+                if not outbox:
+                    del self.outboxes[addr]
+                    return
+                msg_type, msg_format, message = outbox.popleft()
+
+            # each client has its own outgoing sequence numbers, kept in its session
+            session = self.transport.sessions.get(addr)
+            seqno = session.next_seq or random.randint(1, 100000)
+            try:
+                session.next_seq = util.reliable_send_msg(self.transport, msg_type, msg_format,
+                                                          addr, seqno, message,
+                                                          window=self.window,
+                                                          max_retries=util.MAX_RETRIES)
+            except OSError:
+                # the message may have been delivered with only its acks lost, so
+                # the next one must not reuse its seqnos or the client drops it as a duplicate
+                session.next_seq = seqno + util.message_packets(msg_type, msg_format, message)
+
+                # client is gone or server is closing, drop everything queued for it
+                with self.outboxes_lock:
+                    del self.outboxes[addr]
+                username = self.clients.get_name(addr)
+                if username and self.clients.remove(username):
+                    print(f"disconnected: {username} stopped acknowledging")
+                return
+
     def delete_client(self, msg_parts):
         username = msg_parts[2]
 
         # ensure user exists
-        if username in self.clients.keys():
-            del self.clients[username]
+        if self.clients.remove(username):
             print(f"disconnected: {username}")
 
     def add_client(self, msg_parts, addr):
@@ -101,40 +211,32 @@ class Server:
 
         # check for max number of clients
         if len(self.clients) >= util.MAX_NUM_CLIENTS:
-            util.reliable_send_msg(self.sock, "err_server_full", 2, addr,
-                                   self.clients_seq[addr])
+            self.send(addr, "err_server_full", 2)
             print(f"disconnected: server full")
+            return
 
         # check if username already exists
-        if username in self.clients.keys():
-            util.reliable_send_msg(self.sock, "err_username_unavailable", 2, addr,
-                                   self.clients_seq[addr])
+        if username in self.clients:
+            self.send(addr, "err_username_unavailable", 2)
             print(f"disconnected: username not available")
+            return
 
-        self.clients[username] = addr
+        self.clients.add(username, addr)
         print(f"join: {username}")
 
     def send_users_list(self, addr):
         # ensure user exists
-        username = None
-        for name, stored_addr in self.clients.items():
-            if stored_addr == addr:
-                username = name
+        username = self.clients.get_name(addr)
 
         if username:
-            name_list = sorted(self.clients.keys())
-            response_str = f"{len(name_list)} {' '.join(name_list)}"
+            response_str = self.clients.users_list()
             print("sending users list:", response_str)
-            util.reliable_send_msg(self.sock, "response_users_list", 3, addr,
-                                   self.clients_seq[addr], response_str)
+            self.send(addr, "response_users_list", 3, response_str)
             print(f"request_users_list: {username}")
 
     def send_chat_msg(self, msg_parts, addr):
         # ensure sender exists
-        sender_name = None
-        for name, stored_addr in self.clients.items():
-            if stored_addr == addr:
-                sender_name = name
+        sender_name = self.clients.get_name(addr)
 
         if sender_name:
             print(f"msg: {sender_name}")
@@ -146,11 +248,10 @@ class Server:
             # deliver msg to each recipient
             for recipient in recipients:
                 # ensure recipient exists and get address
-                recv_addr = self.clients.get(recipient)
+                recv_addr = self.clients.get_addr(recipient)
                 msg_formatted = f"1 {sender_name} {msg}"
                 if recv_addr:
-                    util.reliable_send_msg(self.sock, "forward_message", 4, recv_addr,
-                                           self.clients_seq[addr], msg_formatted)
+                    self.send(recv_addr, "forward_message", 4, msg_formatted)
                 else:
                     print(f"msg: {sender_name} to non-existent user {recipient}")
 
@@ -171,7 +272,7 @@ if __name__ == "__main__":
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "p:a:w", ["port=", "address=", "window="])
+                                   "p:a:w:", ["port=", "address=", "window="])
     except getopt.GetoptError:
         helper()
         exit()
@@ -186,7 +287,7 @@ if __name__ == "__main__":
         elif o in ("-a", "--address="):
             DEST = a
         elif o in ("-w", "--window="):
-            WINDOW = a
+            WINDOW = int(a)
 
     SERVER = Server(DEST, PORT, WINDOW)
     try:
@@ -2,11 +2,33 @@
 This file contains basic utility functions that you can use and can also make your helper functions here
 '''
 import binascii
+import selectors
 import socket
+import struct
+import time
+from collections import OrderedDict
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
 
 MAX_NUM_CLIENTS = 10
-TIME_OUT = 0.5  # 500ms
+TIME_OUT = 0.5  # 500ms, initial retransmission timeout before any RTT sample
+MIN_TIME_OUT = 0.01  # 10ms
+MAX_TIME_OUT = 8.0  # 8s
 CHUNK_SIZE = 1400  # 1400 Bytes
+MAX_RETRIES = 10  # consecutive timeouts before the server gives up on a client
+SEND_WORKERS = 16  # server threads delivering messages to clients
+SESSION_TIME_OUT = 300  # 5 minutes without traffic before a peer's session is dropped
+SESSION_SWEEP_INTERVAL = 10  # seconds between idle session sweeps
+MAX_SESSION_BYTES = 1 << 20  # 1MB cap on a partially received message
+PACKET_OVERHEAD = 64  # bytes charged against MAX_SESSION_BYTES per buffered packet, so empty ones count too
+MAX_SEQ_AHEAD = MAX_SESSION_BYTES // CHUNK_SIZE + 2  # no message within the cap spans more packets
+LINK_MODEL = None  # optional callable wrapping every Transport socket, see linkemu.py
+PACKET_FORMAT = "binary"  # "binary" header, or "text" for `type|seq|msg|checksum` packets
+
+PACKET_TYPES = ["data", "ack", "start", "end"]
+PACKET_CODES = {name: code for code, name in enumerate(PACKET_TYPES)}
+HEADER_PREFIX = struct.Struct("!BIH")  # type, seqno, payload length
+HEADER = struct.Struct("!BIHI")  # header prefix followed by its crc32
 
 
 def validate_checksum(message):
@@ -53,6 +75,65 @@ def parse_packet(message):
     return msg_type, seqno, data, checksum
 
 
+def pack_packet(msg_type, seqno, payload=b""):
+    '''
+    Builds a binary packet: a fixed size header (type, seqno, length, crc32) then the payload.
+    The crc32 covers the header fields and the payload.
+    '''
+    prefix = HEADER_PREFIX.pack(PACKET_CODES[msg_type], seqno, len(payload))
+    checksum = binascii.crc32(payload, binascii.crc32(prefix))
+    return b"".join((prefix, checksum.to_bytes(4, "big"), payload))
+
+
+def unpack_packet(packet):
+    '''
+    Parses a binary packet without copying the payload.
+    Returns (msg_type, seqno, payload) with payload as a memoryview of packet,
+    or None if the packet is malformed or fails its checksum.
+    '''
+    view = memoryview(packet)
+    if len(view) < HEADER.size:
+        return None
+    code, seqno, length, checksum = HEADER.unpack_from(view)
+    payload = view[HEADER.size:]
+    if code >= len(PACKET_TYPES) or len(payload) != length:
+        return None
+    if binascii.crc32(payload, binascii.crc32(view[:HEADER_PREFIX.size])) != checksum:
+        return None
+    return PACKET_TYPES[code], seqno, payload
+
+
+def encode_packet(msg_type, seqno, payload=b""):
+    '''
+    Builds a packet from a bytes payload in the configured PACKET_FORMAT
+    '''
+    if PACKET_FORMAT == "text":
+        body = b"%s|%d|%s|" % (msg_type.encode(), seqno, payload)
+        return body + generate_checksum(body).encode()
+    return pack_packet(msg_type, seqno, payload)
+
+
+def decode_packet(packet):
+    '''
+    Parses and validates a packet in the configured PACKET_FORMAT.
+    Returns (msg_type, seqno, payload) or None if the packet is invalid.
+    '''
+    if PACKET_FORMAT == "text":
+        try:
+            body, checksum = packet.rsplit(b'|', 1)
+            body += b'|'
+            if generate_checksum(body).encode() != checksum:
+                return None
+            msg_type, seqno, payload = body[:-1].split(b'|', 2)
+            msg_type = msg_type.decode()
+            if msg_type not in PACKET_CODES:
+                return None
+            return msg_type, int(seqno), payload
+        except ValueError:
+            return None
+    return unpack_packet(packet)
+
+
 def make_message(msg_type, msg_format, message=None):
     '''
     This function can be used to format your message according
@@ -76,92 +157,413 @@ def send_msg(sock, msg_type, msg_format, addr, message=None):
     sock.sendto(packet.encode(), addr)
 
 
-def reliable_send_msg(sock, msg_type, msg_format, send_addr, seqno, message=None):
-    # reliably send a message to send_addr
-    msg = make_message(msg_type, msg_format, message=message)
+class RttEstimator:
+    '''
+    Retransmission timer for one peer (RFC 6298).
+    Keeps the smoothed RTT and RTT variance from acked packets and
+    doubles the timeout on every expiry until a fresh sample arrives.
+    '''
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = TIME_OUT
+        self.samples = 0
+        self.timeouts = 0
+        self.lock = Lock()
+
+    def sample(self, rtt):
+        # update the estimates with a measured round trip time
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+            self.rto = min(max(self.srtt + self.K * self.rttvar, MIN_TIME_OUT), MAX_TIME_OUT)
+            self.samples += 1
+
+    def back_off(self):
+        # exponential backoff after the timer expired
+        with self.lock:
+            self.rto = min(self.rto * 2, MAX_TIME_OUT)
+            self.timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto,
+                    "samples": self.samples, "timeouts": self.timeouts}
+
+
+def message_packets(msg_type, msg_format, message=None):
+    # how many seqnos reliable_send_msg uses for a message: start, data chunks and end
+    size = len(make_message(msg_type, msg_format, message=message).encode())
+    return -(-size // CHUNK_SIZE) + 2
+
+
+def reliable_send_msg(transport, msg_type, msg_format, send_addr, seqno, message=None, window=1,
+                      max_retries=None):
+    '''
+    Reliably sends a message to send_addr with a go-back-n sliding window.
+    Up to `window` packets are kept in flight and the receiver acknowledges
+    cumulatively with the next sequence number it expects.
+    Acks are read from the Transport that owns the socket.
+    Returns the sequence number following the end packet, raises TimeoutError
+    after max_retries consecutive timeouts (None retries forever).
+    A window below 1 is treated as 1, it would never send anything.
+    '''
+    window = max(1, window)
+    send_addr = transport.resolve(send_addr)
+    msg = memoryview(make_message(msg_type, msg_format, message=message).encode())
 
     # split into message into chunks
     chunks = [msg[i:i + CHUNK_SIZE] for i in range(0, len(msg), CHUNK_SIZE)]
 
-    # send start
-    start_packet = make_packet("start", seqno)
-    send_and_wait_ack(sock, start_packet, send_addr, seqno)
-    seqno += 1
+    # start, data and end packets are numbered consecutively from seqno
+    packets = [encode_packet("start", seqno)]
+    for i, chunk in enumerate(chunks):
+        packets.append(encode_packet("data", seqno + 1 + i, chunk))
+    packets.append(encode_packet("end", seqno + len(chunks) + 1))
 
-    # send data
-    for chunk in chunks:
-        chunk_packet = make_packet("data", seqno, chunk)
-        send_and_wait_ack(sock, chunk_packet, send_addr, seqno)
-        seqno += 1
+    rtt = transport.rtt_estimator(send_addr)
+    send_times = [None] * len(packets)
+    retransmitted = [False] * len(packets)
 
-    # send end
-    end_packet = make_packet("end", seqno)
-    send_and_wait_ack(sock, end_packet, send_addr, seqno)
+    base = 0  # index of the oldest unacked packet
+    next_index = 0  # index of the next packet to send
+    retries = 0
+    while base < len(packets):
+        # fill the window
+        while next_index < len(packets) and next_index < base + window:
+            transport.sendto(packets[next_index], send_addr)
+            if send_times[next_index] is None:
+                transport.count(packets_sent=1)
+            else:
+                retransmitted[next_index] = True
+                transport.count(packets_sent=1, retransmits=1)
+            send_times[next_index] = time.monotonic()
+            next_index += 1
 
-
-def send_and_wait_ack(sock, packet, send_addr, seqno):
-    while True:
-        sock.sendto(packet.encode(), send_addr)
-        sock.settimeout(TIME_OUT)
-        # wait for ack
-        try:
-            res, _ = sock.recvfrom(4096)
-            res_type, res_seq, res_data, _ = parse_packet(res.decode())
-            # print(f"ACK_SEQNUM: {res_seq}, SEQNO+1: {seqno + 1}") # debug statement
-            if res_type == "ack" and res_seq.isdigit() and int(res_seq) == seqno + 1:
-                break  # successfully sent
-        except socket.timeout:
-            # try again if timed out
+        ack_seq = transport.wait_ack(send_addr, rtt.rto)
+        if ack_seq is None:
+            # timed out, back off and resend everything in flight
+            rtt.back_off()
+            transport.count(timeouts=1)
+            retries += 1
+            if max_retries is not None and retries > max_retries:
+                raise TimeoutError(f"no ack from {send_addr} after {max_retries} retries")
+            next_index = base
             continue
-        finally:
-            sock.settimeout(None)
 
+        # slide the window up to the cumulative ack
+        acked = ack_seq - seqno
+        if base < acked <= len(packets):
+            base = acked
+            retries = 0
+            # Karn's rule: only sample packets that were sent exactly once
+            if not retransmitted[acked - 1]:
+                rtt.sample(time.monotonic() - send_times[acked - 1])
 
-def receive_msg(sock, buffers):
-    try:
-        # peek so we don't remove an ACK, leave it for the other recv
-        packet_peek, addr = sock.recvfrom(4096, socket.MSG_PEEK)
-        packet_str = packet_peek.decode()
-    except (socket.timeout, BlockingIOError):
-        return None, None, None
-
-    # validate checksum
-    if not validate_checksum(packet_str):
-        sock.recvfrom(4096)  # consume invalid packet
-        return None, None, None
-
-    msg_type, seq_str, data, _ = parse_packet(packet_str)
-    if msg_type == "ack":
-        # leave it on the socket for send_and_wait_ack
-        return None, None, None
-
-    # it's not an ack, handle as normal
-    packet, addr = sock.recvfrom(4096)
-    packet = packet.decode()
-    if not validate_checksum(packet):
-        return None, None, None
-
-    msg_type, seq_str, data, _ = parse_packet(packet)
-    seq = int(seq_str)
-    buffer = buffers.setdefault(addr, {"chunks": [], "expected": seq})
-
-    if msg_type == "start":
-        buffer["expected"] += 1
-        ack = make_packet("ack", buffer["expected"])
-        sock.sendto(ack.encode(), addr)
-
-    elif msg_type == "data":
-        buffer["chunks"].append(data)
-        buffer["expected"] += 1
-        ack = make_packet("ack", buffer["expected"])
-        sock.sendto(ack.encode(), addr)
-
-    elif msg_type == "end":
-        buffer["expected"] += 1
-        ack = make_packet("ack", buffer["expected"])
-        sock.sendto(ack.encode(), addr)
-        message = "".join(buffer["chunks"])
-        buffers.pop(addr, None)
-        return message, addr, buffer["expected"]
-
-    return None, None, None
+    transport.count(messages_sent=1, bytes_sent=len(msg))
+    return seqno + len(packets)
+
+
+class Session:
+    '''
+    Transport state kept for one peer: reassembly of the message being received,
+    the ack queue and RTT estimate used when sending to it and the next outgoing seqno.
+    `start`/`expected` are None while no message is in progress and
+    `pending` holds packets that arrived ahead of `expected`.
+    '''
+    __slots__ = ("addr", "start", "expected", "chunks", "pending", "buffered",
+                 "last_start", "last_end", "last_seen", "acks", "rtt", "next_seq")
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.start = None
+        self.expected = None
+        self.chunks = []
+        self.pending = {}  # seq : (msg_type, data)
+        self.buffered = 0  # bytes held in chunks and pending, PACKET_OVERHEAD included
+        self.last_start = None
+        self.last_end = None
+        self.last_seen = time.monotonic()
+        self.acks = None  # Queue of ack seqnos, created by the first sender
+        self.rtt = None  # RttEstimator, created by the first sender
+        self.next_seq = None
+
+    def reset(self):
+        # drop any partially received message
+        self.start = None
+        self.expected = None
+        self.chunks = []
+        self.pending = {}
+        self.buffered = 0
+
+
+class SessionTable:
+    '''
+    Sessions keyed by peer address in least recently seen order, so sessions
+    that have been silent for idle_timeout seconds are evicted from the front.
+    '''
+
+    def __init__(self, idle_timeout=SESSION_TIME_OUT):
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()  # addr : Session
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, addr):
+        '''
+        Returns the session for addr, creating it if needed, and marks it as seen now
+        '''
+        with self.lock:
+            session = self.sessions.get(addr)
+            if session is None:
+                session = self.sessions[addr] = Session(addr)
+            else:
+                self.sessions.move_to_end(addr)
+            session.last_seen = time.monotonic()
+            return session
+
+    def evict_idle(self):
+        '''
+        Removes sessions idle for longer than idle_timeout and returns how many were removed
+        '''
+        cutoff = time.monotonic() - self.idle_timeout
+        evicted = 0
+        with self.lock:
+            while self.sessions:
+                session = next(iter(self.sessions.values()))
+                if session.last_seen > cutoff:
+                    break
+                self.sessions.popitem(last=False)
+                evicted += 1
+            if evicted > len(self.sessions):
+                # dicts never shrink, rebuild so a burst of clients doesn't pin memory
+                self.sessions = OrderedDict(self.sessions)
+        return evicted
+
+    def values(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+
+def hold_packet(session, msg_type, seq, data):
+    '''
+    Adds a packet to the session's pending packets, returns False if that would go over MAX_SESSION_BYTES
+    '''
+    size = len(data) + PACKET_OVERHEAD
+    if session.buffered + size > MAX_SESSION_BYTES:
+        return False
+    session.pending[seq] = (msg_type, data)
+    session.buffered += size
+    return True
+
+
+def handle_packet(session, msg_type, seq, data):
+    '''
+    Adds a start/data/end packet to a peer's reassembly state.
+    Returns (message, ack_seq): message is the reassembled string once the end
+    packet is reached in order, ack_seq is the cumulative ack to send (or None).
+    data is the packet payload as bytes or a memoryview.
+    A message that would buffer more than MAX_SESSION_BYTES, counting PACKET_OVERHEAD
+    for every packet, is dropped, and packets more than MAX_SEQ_AHEAD past the
+    expected one are ignored.
+    '''
+    if msg_type == "start" and seq != session.start:
+        if seq == session.last_start:
+            # duplicate of a message we already delivered
+            return None, session.last_end + 1
+
+        # a new message begins, keep anything that arrived ahead of its start
+        session.chunks = []
+        session.pending = {s: p for s, p in session.pending.items() if seq < s <= seq + MAX_SEQ_AHEAD}
+        session.buffered = sum(len(data) + PACKET_OVERHEAD for _, data in session.pending.values())
+        session.start = seq
+        session.expected = seq + 1
+
+    elif session.expected is None:
+        # no message in progress
+        if session.last_start is not None and session.last_start <= seq <= session.last_end:
+            # our ack for the last message was lost, ack it again
+            return None, session.last_end + 1
+        # arrived before its start packet, hold on to it
+        if seq not in session.pending and not hold_packet(session, msg_type, seq, data):
+            session.reset()
+        return None, None
+
+    elif session.expected <= seq <= session.expected + MAX_SEQ_AHEAD and seq not in session.pending:
+        if not hold_packet(session, msg_type, seq, data):
+            session.reset()
+            return None, None
+
+    # consume every packet that is now in order
+    pending = session.pending
+    while session.expected in pending:
+        seq = session.expected
+        msg_type, data = pending.pop(seq)
+        session.expected += 1
+
+        if msg_type == "data":
+            session.chunks.append(data)
+        elif msg_type == "end":
+            message = b"".join(session.chunks).decode(errors="replace")
+            session.last_start = session.start
+            session.last_end = seq
+            session.reset()
+            return message, seq + 1
+
+    return None, session.expected
+
+
+class Transport:
+    '''
+    Owns a UDP socket and demultiplexes everything that arrives on it.
+    A single reader thread parses and checksums each datagram once, then
+    routes acks to the sender waiting on that address and start/data/end
+    packets to the reassembly buffers. Completed messages are queued for receive().
+    The reader blocks in a selector until the socket is readable or close() wakes it.
+    '''
+
+    def __init__(self, sock):
+        self.sock = LINK_MODEL(sock) if LINK_MODEL else sock
+        self.sessions = SessionTable()
+        self.acks_lock = Lock()
+        self.messages = Queue()  # (message, addr, next_seq)
+        self.addrs = {}  # (host, port) : (ip, port)
+        self.closed = Event()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.reader = Thread(target=self.read_loop, daemon=True)
+        self.stats_lock = Lock()
+        self.stats = {"messages_sent": 0, "bytes_sent": 0, "packets_sent": 0,
+                      "retransmits": 0, "timeouts": 0, "messages_received": 0,
+                      "bytes_received": 0, "bad_packets": 0}
+
+    def start(self):
+        self.reader.start()
+        return self
+
+    def close(self):
+        '''
+        Stops the reader, closes the socket and wakes every thread blocked on the transport:
+        receive() returns (None, None, None) and pending sends fail with OSError.
+        '''
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.wakeup_send.send(b"x")
+        if self.reader.is_alive():
+            self.reader.join()
+
+        self.selector.close()
+        self.sock.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+        for session in self.sessions.values():
+            if session.acks is not None:
+                session.acks.put(None)
+        self.messages.put((None, None, None))
+
+    def resolve(self, addr):
+        # map a hostname address to the ip address datagrams come back from
+        resolved = self.addrs.get(addr)
+        if resolved is None:
+            resolved = self.addrs[addr] = (socket.gethostbyname(addr[0]), addr[1])
+        return resolved
+
+    def sendto(self, packet, addr):
+        self.sock.sendto(packet, addr)
+
+    def count(self, **counters):
+        # add to the transport counters
+        with self.stats_lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    def read_loop(self):
+        next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+        while not self.closed.is_set():
+            if time.monotonic() >= next_sweep:
+                self.sessions.evict_idle()
+                next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+
+            for key, _ in self.selector.select(SESSION_SWEEP_INTERVAL):
+                if key.fileobj is not self.sock:
+                    continue  # woken up by close()
+                try:
+                    packet, addr = self.sock.recvfrom(4096)
+                except ConnectionError:
+                    continue  # icmp error from a peer that went away
+                self.handle_datagram(packet, addr)
+
+    def handle_datagram(self, packet, addr):
+        parsed = decode_packet(packet)
+        if parsed is None:
+            self.count(bad_packets=1)
+            return  # corrupted or malformed
+        msg_type, seq, data = parsed
+
+        session = self.sessions.get(addr)
+        if msg_type == "ack":
+            self.ack_queue(session).put(seq)
+            return
+
+        message, ack_seq = handle_packet(session, msg_type, seq, data)
+        if ack_seq is not None:
+            self.sock.sendto(encode_packet("ack", ack_seq), addr)
+        if message is not None:
+            self.count(messages_received=1, bytes_received=len(message))
+            self.messages.put((message, addr, ack_seq))
+
+    def ack_queue(self, session):
+        with self.acks_lock:
+            if session.acks is None:
+                session.acks = Queue()
+            return session.acks
+
+    def rtt_estimator(self, addr):
+        '''
+        Returns the RTT estimator for addr, creating it on first use
+        '''
+        session = self.sessions.get(addr)
+        with self.acks_lock:
+            if session.rtt is None:
+                session.rtt = RttEstimator()
+            return session.rtt
+
+    def rtt_stats(self):
+        '''
+        Returns the current RTT estimates of every peer as {addr: stats}
+        '''
+        return {session.addr: session.rtt.stats()
+                for session in self.sessions.values() if session.rtt is not None}
+
+    def wait_ack(self, addr, timeout):
+        '''
+        Waits up to timeout seconds for an ack from addr and returns its sequence number,
+        or None if the timer expired first.
+        '''
+        try:
+            return self.ack_queue(self.sessions.get(addr)).get(timeout=timeout)
+        except Empty:
+            return None
+
+    def receive(self):
+        '''
+        Blocks until a complete message arrives and returns (message, addr, next_seq),
+        or (None, None, None) once the transport is closed
+        '''
+        if self.closed.is_set():
+            return None, None, None
+        return self.messages.get()